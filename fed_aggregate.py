@@ -1,5 +1,5 @@
 # aggregate.py
-# Updated to accept --method flag (supports only 'fedavg')
+# --method: fedavg / fedavgm / fedadam / fedyogi / median / trimmed_mean
 
 # +
 # #!/usr/bin/env python
@@ -12,6 +12,7 @@ FedAvg 權重聚合 for YOLOv9
 import os
 import sys
 import argparse
+import functools
 import yaml
 import torch
 
@@ -32,13 +33,37 @@ class CheckpointModel:
         return self._sd
 
 
-def load_state_dict(path):
+def load_state_dict(path, mmap=False, base=None):
     """
     從 .pt 檔案獲取純 state_dict
-    支援 raw dict、{'model_state_dict':...}、{'model': nn.Module} 等格式
+    支援 raw dict、{'model_state_dict':...}、{'model': nn.Module}、fed_update.py 更新檔等格式
+    mmap=True 時以記憶體映射方式讀取 tensor（torch>=2.1），不會一次把整個檔案讀進 RAM
+    base: 更新檔為 delta 格式時使用的 global 權重路徑
+    """
+    return state_dict_from_ckpt(load_checkpoint(path, mmap=mmap), base=base)
+
+
+def load_checkpoint(path, mmap=False):
+    """
+    torch.load 到 CPU；mmap=True 時以記憶體映射方式讀取 tensor（torch>=2.1）
+    """
+    if mmap:
+        try:
+            return torch.load(path, map_location='cpu', mmap=True)
+        except (TypeError, RuntimeError):
+            # 舊版 torch 不支援 mmap，或舊式 (非 zipfile) 序列化格式
+            pass
+    return torch.load(path, map_location='cpu')
+
+
+def state_dict_from_ckpt(ckpt, base=None):
+    """
+    從已載入的 checkpoint 取出純 state_dict（格式同 load_state_dict）
     """
-    ckpt = torch.load(path, map_location='cpu')
     if isinstance(ckpt, dict):
+        from fed_update import is_update, decode_update
+        if is_update(ckpt):
+            return decode_update(ckpt, _load_base(base, *_stat_key(base)) if base else None)
         if 'model_state_dict' in ckpt:
             return ckpt['model_state_dict']
         if 'model' in ckpt and hasattr(ckpt['model'], 'state_dict'):
@@ -47,18 +72,81 @@ def load_state_dict(path):
     return ckpt
 
 
-def federated_average(state_dicts, sizes=None):
+@functools.lru_cache(maxsize=1)
+def _load_base(path, mtime_ns, size):
+    # 同一輪所有更新檔共用同一個 base，只載入一次；mtime / size 也是 cache key，同一路徑被重寫後會重新載入
+    return load_state_dict(path)
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def client_weights(n, sizes=None):
     """
-    FedAvg：對所有 client 的 state_dict 做加權平均
+    依樣本數計算各 client 的聚合權重（未提供 sizes 時為均等權重）
     """
-    n = len(state_dicts)
     if sizes:
         if len(sizes) != n:
             raise ValueError("sizes 長度必須等於模型數量")
         total = float(sum(sizes))
-        weights = [s / total for s in sizes]
-    else:
-        weights = [1.0 / n] * n
+        return [s / total for s in sizes]
+    return [1.0 / n] * n
+
+
+# ---------------------------------------------------------------------------
+# BatchNorm 統計量：Conv / RepConvN 的 .bn 子模組
+#   avg    : running_mean / running_var 直接加權平均
+#   pooled : running_var 以 pooled variance 合併 = sum(w * (var_i + mean_i^2)) - mean^2
+#            （within-client + between-client variance）
+#   local  : FedBN，global model 仍存平均後的 BN，另輸出每個 client 保留自身 BN 的權重檔
+# num_batches_tracked 一律四捨五入後還原為整數
+# ---------------------------------------------------------------------------
+BN_MODES = ['avg', 'pooled', 'local']
+BN_PARAM_SUFFIXES = ('weight', 'bias', 'running_mean', 'running_var', 'num_batches_tracked')
+
+
+def bn_keys(sd):
+    """
+    回傳 state_dict 中所有 BatchNorm 相關 key（以 running_mean 辨識 BN 模組）
+    """
+    prefixes = {k[:-len('running_mean')] for k in sd if k.endswith('.running_mean')}
+    return [k for k in sd if k[:k.rfind('.') + 1] in prefixes and k.endswith(BN_PARAM_SUFFIXES)]
+
+
+def bn_second_moment(sd):
+    """
+    running_var 轉成二階動差 E[x^2] = var + mean^2，使其可線性平均
+    """
+    out = dict(sd)
+    for k in sd:
+        if k.endswith('.running_var'):
+            mean = sd[k[:-len('running_var')] + 'running_mean'].float()
+            out[k] = sd[k].float() + mean * mean
+    return out
+
+
+def finalize_bn(avg_sd, bn='avg'):
+    """
+    聚合後處理：pooled 模式將 E[x^2] 還原為 variance；num_batches_tracked 還原為整數
+    """
+    for k in avg_sd:
+        if k.endswith('.running_var') and bn == 'pooled':
+            mean = avg_sd[k[:-len('running_var')] + 'running_mean']
+            avg_sd[k] = (avg_sd[k] - mean * mean).clamp_(min=0)
+        elif k.endswith('.num_batches_tracked'):
+            avg_sd[k] = avg_sd[k].round().long()
+    return avg_sd
+
+
+def federated_average(state_dicts, sizes=None, bn='avg'):
+    """
+    FedAvg：對所有 client 的 state_dict 做加權平均
+    """
+    weights = client_weights(len(state_dicts), sizes)
+    if bn == 'pooled':
+        state_dicts = [bn_second_moment(sd) for sd in state_dicts]
 
     # 取交集 keys
     keys = set(state_dicts[0].keys())
@@ -73,7 +161,306 @@ def federated_average(state_dicts, sizes=None):
         for w, sd in zip(weights, state_dicts):
             acc += sd[k].float() * w
         avg_sd[k] = acc
-    return avg_sd
+    return finalize_bn(avg_sd, bn)
+
+
+def streaming_federated_average(paths, sizes=None, mmap=True, bn='avg', base=None):
+    """
+    串流式 FedAvg：一次只載入一個 client，累加至 float32 accumulator
+    峰值記憶體約為兩份模型（accumulator + 當前 client），與 client 數量無關
+    結果與 federated_average() 相同（取所有 client 的 key 交集）
+    """
+    weights = client_weights(len(paths), sizes)
+    return finalize_bn(dict(sorted(_accumulate(paths, weights, mmap=mmap, bn=bn, base=base).items())), bn)
+
+
+def _accumulate(paths, weights, mmap=True, acc=None, bn='avg', base=None):
+    """
+    逐一載入 paths 中的 client，將加權後的 tensor 累加進 acc（float32），僅保留 key 交集
+    """
+    for w, f in zip(weights, paths):
+        sd = load_state_dict(f, mmap=mmap, base=base)
+        if bn == 'pooled':
+            sd = bn_second_moment(sd)
+        if acc is None:
+            acc = {k: torch.zeros_like(v, dtype=torch.float32)
+                   for k, v in sd.items() if isinstance(v, torch.Tensor)}
+        else:
+            # 取交集 keys：不在當前 client 的 key 直接丟棄
+            for k in [k for k in acc if k not in sd]:
+                del acc[k]
+        for k, a in acc.items():
+            a += sd[k].float() * w
+        del sd
+    return acc
+
+
+def _accumulate_shard(job):
+    """
+    Worker：對一組 client 做部分加權和，攤平成單一 float32 buffer 回傳
+    （只佔用一段 shared memory，避免上千個小 tensor 各自開一個 fd）
+    """
+    paths, weights, mmap, bn, base = job
+    acc = _accumulate(paths, weights, mmap=mmap, bn=bn, base=base)
+    keys = list(acc)
+    shapes = [acc[k].shape for k in keys]
+    flat = torch.cat([acc[k].reshape(-1) for k in keys]) if keys else torch.zeros(0)
+    return keys, shapes, flat
+
+
+def parallel_federated_average(paths, sizes=None, jobs=2, mmap=True, bn='avg', base=None):
+    """
+    平行 FedAvg：client 依 round-robin 分成 jobs 份，由 process pool 各自解碼並計算部分加權和，
+    主程序在部分和陸續完成時累加（reduce），峰值記憶體約為 accumulator + 一份部分和
+    """
+    weights = client_weights(len(paths), sizes)
+    jobs = max(1, min(jobs, len(paths)))
+    shards = [(paths[i::jobs], weights[i::jobs], mmap, bn, base) for i in range(jobs)]
+    acc = None
+    ctx = torch.multiprocessing.get_context('spawn')
+    with ctx.Pool(jobs) as pool:
+        for keys, shapes, flat in pool.imap_unordered(_accumulate_shard, shards):
+            numels = [s.numel() for s in shapes]
+            part = {k: t.view(s) for k, s, t in zip(keys, shapes, flat.split(numels))}
+            if acc is None:
+                acc = {k: t.clone() for k, t in part.items()}
+            else:
+                for k in [k for k in acc if k not in part]:
+                    del acc[k]
+                for k, a in acc.items():
+                    a += part[k]
+            del part, flat
+    return finalize_bn(dict(sorted(acc.items())), bn)
+
+
+# ---------------------------------------------------------------------------
+# Robust aggregation：逐座標統計量，需同時持有所有 client（以 mmap 載入可降低 RAM）
+# ---------------------------------------------------------------------------
+def _common_float_keys(state_dicts):
+    keys = set(state_dicts[0].keys())
+    for sd in state_dicts[1:]:
+        keys &= set(sd.keys())
+    return [k for k in sorted(keys) if isinstance(state_dicts[0][k], torch.Tensor)]
+
+
+def coordinate_median(state_dicts, sizes=None, bn='avg', **kwargs):
+    """
+    逐座標中位數（不使用 sizes 加權）；bn='pooled' 時 running_var 以 E[x^2] 取中位數後再還原為 variance
+    """
+    if bn == 'pooled':
+        state_dicts = [bn_second_moment(sd) for sd in state_dicts]
+    out = {}
+    for k in _common_float_keys(state_dicts):
+        stacked = torch.stack([sd[k].float() for sd in state_dicts])
+        out[k] = stacked.median(dim=0).values
+    return finalize_bn(out, bn)
+
+
+def trimmed_mean(state_dicts, sizes=None, trim_ratio=0.1, bn='avg', **kwargs):
+    """
+    逐座標截尾平均：每個座標去掉最大與最小各 floor(trim_ratio * n) 個值後取平均
+    bn='pooled' 時 running_var 以 E[x^2] 截尾平均後再還原為 variance
+    """
+    n = len(state_dicts)
+    t = int(trim_ratio * n)
+    if 2 * t >= n:
+        raise ValueError(f"trim_ratio={trim_ratio} 對 {n} 個 client 過大")
+    if bn == 'pooled':
+        state_dicts = [bn_second_moment(sd) for sd in state_dicts]
+    out = {}
+    for k in _common_float_keys(state_dicts):
+        stacked = torch.stack([sd[k].float() for sd in state_dicts]).sort(dim=0).values
+        out[k] = stacked[t:n - t].mean(dim=0)
+    return finalize_bn(out, bn)
+
+
+ROBUST_AGGREGATORS = {
+    'median': coordinate_median,
+    'trimmed_mean': trimmed_mean,
+}
+
+
+# ---------------------------------------------------------------------------
+# Server optimizer（Reddi et al., "Adaptive Federated Optimization"）
+# 以 pseudo-gradient delta = avg - global 更新上一輪 global model，state 跨輪保存
+# ---------------------------------------------------------------------------
+BN_BUFFER_SUFFIXES = ('running_mean', 'running_var', 'num_batches_tracked')
+
+
+def _server_fedavgm(delta, state, beta1=0.9, update=True, **kwargs):
+    m = state.setdefault('m', {})
+    step = {}
+    for k, d in delta.items():
+        if update or k not in m:
+            m[k] = m[k].mul_(beta1).add_(d) if k in m else d.clone()
+        step[k] = m[k]
+    return step
+
+
+def _server_adaptive(delta, state, beta1=0.9, beta2=0.99, tau=1e-3, yogi=False, update=True):
+    m, v = state.setdefault('m', {}), state.setdefault('v', {})
+    step = {}
+    for k, d in delta.items():
+        if update or k not in m:
+            if k not in m:
+                m[k] = torch.zeros_like(d)
+                v[k] = torch.full_like(d, tau ** 2)
+            m[k].mul_(beta1).add_(d, alpha=1 - beta1)
+            d2 = d * d
+            if yogi:
+                v[k].sub_((1 - beta2) * d2 * torch.sign(v[k] - d2))
+            else:
+                v[k].mul_(beta2).add_(d2, alpha=1 - beta2)
+        step[k] = m[k] / (v[k].sqrt() + tau)
+    return step
+
+
+def _server_fedadam(delta, state, **kwargs):
+    return _server_adaptive(delta, state, yogi=False, **kwargs)
+
+
+def _server_fedyogi(delta, state, **kwargs):
+    return _server_adaptive(delta, state, yogi=True, **kwargs)
+
+
+SERVER_OPTIMIZERS = {
+    'fedavgm': _server_fedavgm,
+    'fedadam': _server_fedadam,
+    'fedyogi': _server_fedyogi,
+}
+SERVER_LR = {'fedavgm': 1.0, 'fedadam': 1e-2, 'fedyogi': 1e-2}  # 預設 server learning rate
+METHODS = ['fedavg'] + list(SERVER_OPTIMIZERS) + list(ROBUST_AGGREGATORS)
+
+
+def server_update(method, avg_sd, global_sd, state, server_lr=None, server_round=None, **kwargs):
+    """
+    以 server optimizer 更新 global model：x <- x + lr * step(avg - x)
+    BN running 統計量不屬於可學習參數，直接沿用 client 平均
+    server_round: 聯邦輪次；state 已含該輪（上次存完 state 後、global 寫出前中斷）時不再更新 moments，只重算 step
+    """
+    lr = SERVER_LR[method] if server_lr is None else server_lr
+    keys = [k for k in avg_sd if k in global_sd and not k.endswith(BN_BUFFER_SUFFIXES)]
+    delta = {k: avg_sd[k] - global_sd[k].float() for k in keys}
+    repeat = server_round is not None and state.get('server_round') == server_round
+    step = SERVER_OPTIMIZERS[method](delta, state, update=not repeat, **kwargs)
+    out = dict(avg_sd)
+    for k in keys:
+        out[k] = global_sd[k].float() + lr * step[k]
+    state['method'] = method
+    if not repeat:
+        state['round'] = state.get('round', 0) + 1
+    state['server_round'] = server_round
+    return out
+
+
+def load_server_state(path, method):
+    """
+    讀取上一輪 server optimizer state；method 不同或檔案不存在時重新初始化
+    """
+    if path and os.path.isfile(path):
+        state = torch.load(path, map_location='cpu')
+        if state.get('method') == method:
+            return state
+        print(f"[WARNING] {path} 的 method={state.get('method')} 與 {method} 不符，重新初始化 server state")
+    return {}
+
+
+def aggregate(paths, sizes=None, method='fedavg', bn='avg', jobs=1, stream=False, global_model=None,
+              server_state=None, trim_ratio=0.1, **server_kwargs):
+    """
+    依 method 聚合 client 權重並回傳 state_dict
+    paths: client 權重或更新檔；global_model: 上一輪 global 權重路徑（server optimizer 與 delta 更新檔使用）
+    server_state: server optimizer state 檔案路徑；server_kwargs: server_lr / beta1 / beta2 / tau / server_round
+    """
+    if method in ROBUST_AGGREGATORS:
+        # 逐座標統計量需要所有 client 同時在記憶體中（mmap 載入）
+        state_dicts = [load_state_dict(f, mmap=True, base=global_model) for f in paths]
+        return ROBUST_AGGREGATORS[method](state_dicts, sizes=sizes, trim_ratio=trim_ratio, bn=bn)
+    if jobs > 1:
+        # 平行 FedAvg：worker 解碼並計算部分加權和，主程序 reduce
+        agg_sd = parallel_federated_average(paths, sizes=sizes, jobs=jobs, bn=bn, base=global_model)
+    elif stream:
+        # 串流 FedAvg：載入與累加交錯進行
+        agg_sd = streaming_federated_average(paths, sizes=sizes, bn=bn, base=global_model)
+    else:
+        state_dicts = [load_state_dict(f, base=global_model) for f in paths]
+        agg_sd = federated_average(state_dicts, sizes=sizes, bn=bn)
+        del state_dicts
+
+    # Server optimizer：以上一輪 global model 為基準套用 pseudo-gradient
+    if method in SERVER_OPTIMIZERS:
+        if global_model and os.path.isfile(global_model):
+            state = load_server_state(server_state, method)
+            global_sd = load_state_dict(global_model)
+            agg_sd = server_update(method, agg_sd, global_sd, state, **server_kwargs)
+            if server_state:
+                tmp = f'{server_state}.tmp'
+                torch.save(state, tmp)
+                os.replace(tmp, server_state)  # 中斷時不留下寫一半的 state
+            print(f"[OK] {method} server step {state['round']}，state 已存至 {server_state}")
+        else:
+            print(f"[WARNING] 未提供 global model，{method} 本輪退化為 FedAvg")
+    return agg_sd
+
+
+def save_fedbn_models(model, paths, output, base=None, client_ids=None):
+    """
+    FedBN：以 global 權重為底，換回每個 client 自己的 BN 參數，輸出 <output>_client{id}.pt
+    """
+    global_sd = {k: v.clone() for k, v in model.state_dict().items()}
+    stem, ext = os.path.splitext(output)
+    for i, f in zip(client_ids if client_ids is not None else range(len(paths)), paths):
+        sd = load_state_dict(f, mmap=True, base=base)
+        local_sd = dict(global_sd)
+        local_sd.update({k: sd[k] for k in bn_keys(sd) if k in global_sd})
+        model.load_state_dict(local_sd, strict=False)
+        out = f'{stem}_client{i}{ext}'
+        save_checkpoint(model, out)
+        print(f"[OK] FedBN client {i} 權重: {out}")
+        del sd
+    model.load_state_dict(global_sd)
+
+
+def data_nc(data_files):
+    """
+    解析所有 data yaml，確認 nc 欄位一致並回傳 nc
+    """
+    ncs = []
+    for f in data_files:
+        with open(f) as fp:
+            dd = yaml.safe_load(fp)
+            if 'nc' not in dd:
+                raise ValueError(f"{f} 缺少 nc 欄位")
+            ncs.append(int(dd['nc']))
+    if len(set(ncs)) != 1:
+        raise ValueError(f"多個 data yaml 的 nc 不一致: {ncs}")
+    return ncs[0]
+
+
+def save_checkpoint(model, path):
+    """
+    存成 train_dual.py 可讀的 {'model': Model} 格式；先寫暫存檔再 rename，避免 client 讀到寫到一半的檔案
+    """
+    # 注入 CheckpointModel hook
+    CheckpointModel.__module__ = '__main__'
+    import __main__
+    setattr(__main__, 'CheckpointModel', CheckpointModel)
+
+    tmp = f'{path}.tmp'
+    torch.save({'model': model}, tmp)
+    os.replace(tmp, path)
+
+
+def save_global_model(sd, cfg, nc, path):
+    """
+    建立 Model、載入聚合權重並存檔，回傳 Model
+    """
+    model = Model(cfg, ch=3, nc=nc).cpu()
+    missing, unexpected = model.load_state_dict(sd, strict=False)
+    if missing or unexpected:
+        print(f"[WARNING] 載入時 missing: {missing}, unexpected: {unexpected}")
+    save_checkpoint(model, path)
+    return model
 
 
 def parse_args():
@@ -82,7 +469,7 @@ def parse_args():
     )
     p.add_argument(
         '-i','--input-models', nargs='+', required=True,
-        help='Client 權重 .pt 檔列表'
+        help='Client 權重 .pt 檔列表（亦可為 fed_update.py 輸出的更新檔）'
     )
     p.add_argument(
         '-o','--output-model', required=True,
@@ -100,6 +487,40 @@ def parse_args():
         '-s','--sizes', nargs='+', type=int,
         help='各 client 樣本數列表，用於加權平均'
     )
+    p.add_argument(
+        '--stream', action='store_true',
+        help='串流聚合：逐一載入 client 權重，峰值記憶體約兩份模型'
+    )
+    p.add_argument(
+        '-j','--jobs', type=int, default=1,
+        help='平行解碼 client 權重的 process 數（>1 時啟用平行聚合，隱含 --stream）'
+    )
+    p.add_argument(
+        '-m','--method', default='fedavg', choices=METHODS,
+        help='聚合策略'
+    )
+    p.add_argument(
+        '-g','--global-model',
+        help='上一輪 global 權重 (global_round_{R}.pt)，fedavgm/fedadam/fedyogi 及 delta 更新檔需要'
+    )
+    p.add_argument(
+        '--server-state',
+        help='server optimizer state 路徑，預設為輸出目錄下的 server_state.pt'
+    )
+    p.add_argument('--server-lr', type=float, help='server learning rate（預設依 method）')
+    p.add_argument('--round', type=int, help='本輪輪次 R；重跑同一輪時 server state 不重複更新')
+    p.add_argument('--beta1', type=float, default=0.9, help='server momentum / Adam beta1')
+    p.add_argument('--beta2', type=float, default=0.99, help='FedAdam/FedYogi beta2')
+    p.add_argument('--tau', type=float, default=1e-3, help='FedAdam/FedYogi adaptivity')
+    p.add_argument('--trim-ratio', type=float, default=0.1, help='trimmed_mean 每側截去比例')
+    p.add_argument(
+        '--client-ids', nargs='+', type=int,
+        help='各輸入權重對應的 client 編號（--bn local 輸出檔名用，預設為輸入順序）'
+    )
+    p.add_argument(
+        '--bn', default='avg', choices=BN_MODES,
+        help='BatchNorm 聚合方式：avg 平均 / pooled 合併變異數 / local FedBN（另輸出各 client 權重）'
+    )
     return p.parse_args()
 
 
@@ -112,51 +533,34 @@ def main():
             sys.stderr.write(f"[ERROR] 找不到檔案: {f}\n")
             sys.exit(1)
 
-    # 讀取 state_dict
-    state_dicts = []
-    for f in args.input_models:
-        try:
-            state_dicts.append(load_state_dict(f))
-        except Exception as e:
-            sys.stderr.write(f"[ERROR] 載入 {f} 失敗: {e}\n")
-            sys.exit(1)
+    # 解析所有 data yaml，確認 nc 欄位一致
+    try:
+        nc = data_nc(args.data)
+    except ValueError as e:
+        sys.stderr.write(f"[ERROR] {e}\n")
+        sys.exit(1)
 
-    # 執行 FedAvg
+    # 執行聚合
+    state_path = args.server_state or os.path.join(
+        os.path.dirname(os.path.abspath(args.output_model)), 'server_state.pt')
     try:
-        agg_sd = federated_average(state_dicts, sizes=args.sizes)
+        agg_sd = aggregate(args.input_models, sizes=args.sizes, method=args.method, bn=args.bn, jobs=args.jobs,
+                           stream=args.stream, global_model=args.global_model, server_state=state_path,
+                           server_lr=args.server_lr, beta1=args.beta1, beta2=args.beta2, tau=args.tau,
+                           trim_ratio=args.trim_ratio, server_round=args.round)
     except Exception as e:
         sys.stderr.write(f"[ERROR] 聚合失敗: {e}\n")
         sys.exit(1)
 
-    # 解析所有 data yaml，確認 nc 欄位一致
-    ncs = []
-    for f in args.data:
-        with open(f) as fp:
-            dd = yaml.safe_load(fp)
-            if 'nc' not in dd:
-                sys.stderr.write(f"[ERROR] {f} 缺少 nc 欄位\n")
-                sys.exit(1)
-            ncs.append(int(dd['nc']))
-    if len(set(ncs)) != 1:
-        sys.stderr.write(f"[ERROR] 多個 data yaml 的 nc 不一致: {ncs}\n")
-        sys.exit(1)
-    nc = ncs[0]
-
-    # 建立 Model 並載入聚合權重
-    model = Model(args.cfg, ch=3, nc=nc).cpu()
-    missing, unexpected = model.load_state_dict(agg_sd, strict=False)
-    if missing or unexpected:
-        print(f"[WARNING] 載入時 missing: {missing}, unexpected: {unexpected}")
-
-    # 注入 CheckpointModel hook
-    CheckpointModel.__module__ = '__main__'
-    import __main__
-    setattr(__main__, 'CheckpointModel', CheckpointModel)
-
-    # 存成 train_dual.py 可讀的格式
-    torch.save({'model': model}, args.output_model)
+    # 建立 Model 並載入聚合權重，存成 train_dual.py 可讀的格式
+    model = save_global_model(agg_sd, args.cfg, nc, args.output_model)
     print(f"[OK] 聚合完成，輸出: {args.output_model}")
 
+    # FedBN：每個 client 取回自己的 BN 參數，輸出 <output>_client{i}.pt 供下一輪 client 訓練使用
+    if args.bn == 'local':
+        save_fedbn_models(model, args.input_models, args.output_model, base=args.global_model,
+                          client_ids=args.client_ids)
+
 if __name__ == '__main__':
     main()
 
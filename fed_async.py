@@ -0,0 +1,226 @@
+# fed_async.py
+# 非同步 (FedAsync / FedBuff) 聚合 daemon：client 權重一到就累積，滿 K 個即發布新一輪 global
+
+# +
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Staleness-aware 非同步聚合 for Federated YOLOv9
+持續監看 fed_client_weights/，client{N}_r{R} 訓練完成（best.pt 經 strip_optimizer，epoch == -1）
+即計算其相對 global_round_{R}.pt 的 delta，依 staleness s(t) = (1 + t) ^ -a 加權後放入 buffer。
+buffer 累積 K 個更新後：x <- x + server_lr * sum(s_i * delta_i) / K，發布 global_round_{R+1}.pt。
+快的 client 不必等慢的節點，拿到最新的 global 就能開始下一輪。
+
+用法:
+    python fed_async.py \\
+      --cfg models/detect/yolov9-c.yaml \\
+      -d data/kitti_client0.yaml data/kitti_client1.yaml \\
+      --buffer 2 --staleness-exp 0.5
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+import torch
+
+from fed_aggregate import (data_nc, finalize_bn, load_checkpoint, load_state_dict, save_global_model,
+                           state_dict_from_ckpt)
+
+RUN_RE = re.compile(r'client(\d+)_r(\d+)$')
+GLOBAL_RE = re.compile(r'global_round_(\d+)\.pt$')
+
+
+def staleness_weight(tau, a=0.5):
+    """
+    FedAsync polynomial staleness 函數：s(t) = (1 + t) ^ -a
+    """
+    return (1.0 + tau) ** -a
+
+
+class AsyncAggregator:
+    """
+    FedBuff 風格的 buffered 非同步聚合，狀態存於 <out_dir>/async_state.json 可中斷續跑
+    """
+
+    def __init__(self, opt):
+        self.opt = opt
+        self.nc = data_nc(opt.data)
+        self.state_file = os.path.join(opt.out_dir, 'async_state.json')
+        if os.path.isfile(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+        else:
+            rounds = [int(m.group(1)) for m in map(GLOBAL_RE.search, os.listdir(opt.out_dir)) if m]
+            self.state = {'round': max(rounds, default=0), 'seen': [], 'history': []}
+        self.bases = {}  # round -> global state_dict 快取
+        self.not_ready = {}  # path -> mtime，尚在訓練中的 checkpoint，mtime 未變前不再重新載入
+        self._reset_buffer()
+
+    def _reset_buffer(self):
+        self.acc, self.buffered, self.taus = None, [], []
+
+    def global_path(self, r):
+        return os.path.join(self.opt.out_dir, f'global_round_{r}.pt')
+
+    def base(self, r):
+        """
+        讀取 global_round_{r}.pt（快取最近幾輪）；不存在時回傳 None
+        """
+        if r not in self.bases:
+            f = self.global_path(r)
+            if r == 0 or not os.path.isfile(f):
+                return None
+            self.bases[r] = {k: v.float() if v.is_floating_point() else v for k, v in load_state_dict(f).items()}
+            for old in sorted(self.bases)[:-self.opt.cache_rounds]:
+                del self.bases[old]
+        return self.bases[r]
+
+    def pending(self):
+        """
+        掃描尚未處理、且已訓練完成的 client 輸出，回傳 [(run, client, round, path)]
+        """
+        now = time.time()
+        out = []
+        for d in sorted(glob.glob(os.path.join(self.opt.watch, 'client*_r*'))):
+            run = os.path.basename(d)
+            m = RUN_RE.search(run)
+            f = os.path.join(d, 'weights', f'{self.opt.artifact}.pt')
+            if not m or run in self.state['seen'] or run in self.buffered or not os.path.isfile(f):
+                continue
+            mtime = os.path.getmtime(f)
+            if now - mtime < self.opt.settle or self.not_ready.get(f) == mtime:
+                continue  # 檔案仍在寫入，或上次檢查時尚未訓練完成
+            out.append((run, int(m.group(1)), int(m.group(2)), f))
+        return out
+
+    def add(self, run, r, f):
+        """
+        載入一個 client 結果並以 staleness 加權累加到 buffer；回傳 False 表示尚未完成訓練
+        """
+        ckpt = load_checkpoint(f, mmap=True)
+        if isinstance(ckpt, dict) and ckpt.get('epoch', -1) != -1:
+            self.not_ready[f] = os.path.getmtime(f)
+            return False  # train_dual.py 尚未 strip_optimizer，訓練仍在進行
+        cur = self.state['round']
+        tau = cur - r
+        if self.opt.max_staleness is not None and tau > self.opt.max_staleness:
+            print(f"[Async] 丟棄 {run}：staleness {tau} > {self.opt.max_staleness}")
+            self.state['seen'].append(run)
+            self._save_state()
+            return True
+
+        # client 起點的 global 不存在（round 0 從頭訓練）時，以目前 global 為基準（FedAsync 混合）
+        base = self.base(r) if r > 0 else None
+        sd = state_dict_from_ckpt(ckpt, base=self.global_path(r) if base is not None else None)
+        ref = base if base is not None else self.base(cur)
+        w = staleness_weight(tau, self.opt.staleness_exp)
+        if self.acc is None:
+            self.acc = {k: torch.zeros_like(v, dtype=torch.float32)
+                        for k, v in sd.items() if isinstance(v, torch.Tensor) and v.is_floating_point()}
+        for k in [k for k in self.acc if k not in sd]:
+            del self.acc[k]
+        for k, a in self.acc.items():
+            v = sd[k].float()
+            a += (v - ref[k] if ref is not None else v) * w
+        self.buffered.append(run)
+        self.taus.append(tau)
+        print(f"[Async] 加入 {run}：staleness {tau}，權重 {w:.3f}（buffer {len(self.buffered)}/{self.opt.buffer}）")
+        return True
+
+    def publish(self):
+        """
+        套用 buffer 中的更新並發布 global_round_{R+1}.pt
+        """
+        cur = self.state['round']
+        x = self.base(cur)
+        k_buf = len(self.buffered)
+        if x is None:
+            # 尚無 global：以 staleness 加權平均作為第一個 global
+            total = sum(staleness_weight(t, self.opt.staleness_exp) for t in self.taus)
+            new_sd = {k: a / total for k, a in self.acc.items()}
+        else:
+            new_sd = dict(x)
+            for k, a in self.acc.items():
+                new_sd[k] = x[k] + self.opt.server_lr * a / k_buf
+        new_sd = finalize_bn(new_sd)
+
+        save_global_model(new_sd, self.opt.cfg, self.nc, self.global_path(cur + 1))
+        self.state['round'] = cur + 1
+        self.state['seen'] += self.buffered
+        self.state['history'].append({'round': cur + 1, 'clients': self.buffered, 'staleness': self.taus,
+                                      'time': time.strftime('%Y-%m-%d %H:%M:%S')})
+        self._save_state()
+        print(f"[Async] 發布 {self.global_path(cur + 1)}（clients: {', '.join(self.buffered)}）")
+        self._reset_buffer()
+
+    def _save_state(self):
+        tmp = f'{self.state_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.state_file)
+
+    def run(self):
+        published = 0
+        print(f"[Async] 監看 {self.opt.watch}，目前 global round {self.state['round']}，buffer K={self.opt.buffer}")
+        while self.opt.max_rounds is None or published < self.opt.max_rounds:
+            for run, client, r, f in self.pending():
+                try:
+                    if not self.add(run, r, f):
+                        continue
+                except Exception as e:
+                    sys.stderr.write(f"[ERROR] 載入 {f} 失敗: {e}\n")
+                    self.not_ready[f] = os.path.getmtime(f)  # 檔案更新前不再重試
+                    continue
+                if len(self.buffered) >= self.opt.buffer:
+                    self.publish()
+                    published += 1
+                    break  # 重新掃描，讓後續 client 以新 round 計算 staleness
+            else:
+                time.sleep(self.opt.poll)
+
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description='Staleness-aware 非同步聚合 for Federated YOLOv9'
+    )
+    p.add_argument('--watch', default='fed_client_weights', help='client 輸出目錄（client{N}_r{R}/weights/）')
+    p.add_argument('--out-dir', default='global_round_weights', help='global_round_*.pt 輸出目錄')
+    p.add_argument(
+        '--cfg', required=True,
+        help='YOLOv9 模型配置檔 (.yaml)，須與 train_dual.py 使用相同'
+    )
+    p.add_argument(
+        '-d','--data', nargs='+', required=True,
+        help='每個 client 的 data yaml 檔，程式將檢查它們的 nc 是否一致'
+    )
+    p.add_argument('--artifact', default='best', choices=['best', 'last', 'update'],
+                   help='讀取 weights/ 下哪個檔案（update 為 fed_update.py 輸出）')
+    p.add_argument('-k','--buffer', type=int, default=2, help='累積幾個 client 更新後發布新 global')
+    p.add_argument('--staleness-exp', type=float, default=0.5, help='staleness 函數 (1 + t) ^ -a 的 a')
+    p.add_argument('--max-staleness', type=int, help='超過此 staleness 的更新直接丟棄')
+    p.add_argument('--server-lr', type=float, default=1.0, help='server learning rate')
+    p.add_argument('--poll', type=float, default=30, help='掃描間隔（秒）')
+    p.add_argument('--settle', type=float, default=10, help='檔案需靜止幾秒才視為寫入完成')
+    p.add_argument('--cache-rounds', type=int, default=4, help='記憶體中快取幾輪 global 權重')
+    p.add_argument('--max-rounds', type=int, help='發布幾輪後結束（預設持續執行）')
+    return p.parse_args()
+
+
+def main():
+    opt = parse_args()
+    for f in opt.data + [opt.cfg]:
+        if not os.path.isfile(f):
+            sys.stderr.write(f"[ERROR] 找不到檔案: {f}\n")
+            sys.exit(1)
+    os.makedirs(opt.out_dir, exist_ok=True)
+    try:
+        AsyncAggregator(opt).run()
+    except KeyboardInterrupt:
+        print("[Async] 結束")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+# fed_orchestrator.py
+# 聯邦式訓練流程（client 訓練 → 聚合 → 驗證）的 Python 版本，取代 run_client*.sh / run_aggregate.sh / fed_val.sh
+
+# +
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Federated round orchestrator for YOLOv9
+每一輪：N 個 client 以 train_dual.py 訓練 → fed_aggregate 聚合出 global_round_{R+1}.pt → 以 val set 驗證。
+  --mode inprocess  : 在同一個 process 內依序訓練，torch / 模型 / dataloader（--keep-loaders）跨輪保持暖機
+  --mode subprocess : 每個 client 一個 train_dual.py 子程序，由本機版 SLURM（LocalLauncher）依 --devices 分配 GPU
+輪次狀態存於 <global-dir>/orchestrator_state.json，中斷後重新執行同一指令即可從未完成的 client 接續。
+
+用法:
+    python fed_orchestrator.py --clients 0 1 2 3 --rounds 5 --epochs 50 \\
+      --cfg models/detect/yolov9-c.yaml --mode subprocess --devices 0 1 2 3
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+
+import fed_aggregate as fa
+from fed_select import SELECT_METHODS, ClientSelector, final_train_loss, label_count
+from utils.callbacks import Callbacks
+from utils.general import LOGGER, check_dataset, colorstr
+
+
+class LocalLauncher:
+    """
+    本機版 SLURM：每個 device slot 同時只執行一個 job，job 結束後 slot 釋放給下一個
+    """
+
+    def __init__(self, devices, poll=5):
+        self.devices = list(devices)
+        self.poll = poll
+
+    def run(self, jobs):
+        """
+        jobs: [(name, cmd, log_file)]，cmd 會附加 --device <slot>；回傳失敗的 job 名稱列表
+        """
+        queue, running, free, failed = list(jobs), {}, list(self.devices), []
+        while queue or running:
+            while queue and free:
+                dev = free.pop(0)
+                name, cmd, log = queue.pop(0)
+                fh = open(log, 'w')
+                p = subprocess.Popen(cmd + ['--device', dev], stdout=fh, stderr=subprocess.STDOUT)
+                running[p] = (name, dev, fh)
+                print(f"[Launcher] {name} 開始於 device {dev}（log: {log}）")
+            for p in [p for p in running if p.poll() is not None]:
+                name, dev, fh = running.pop(p)
+                fh.close()
+                free.append(dev)
+                if p.returncode != 0:
+                    failed.append(name)
+                print(f"[Launcher] {name} 結束，return code {p.returncode}")
+            if running:
+                time.sleep(self.poll)
+        return failed
+
+
+class FedOrchestrator:
+    """
+    依序執行每一輪 client 訓練、聚合與驗證，並記錄可續跑的輪次狀態
+    """
+
+    def __init__(self, opt):
+        self.opt = opt
+        self.data = [opt.data_pattern.format(c) for c in opt.clients]
+        self.nc = fa.data_nc(self.data)
+        os.makedirs(opt.global_dir, exist_ok=True)
+        os.makedirs(opt.client_dir, exist_ok=True)
+        self.state_file = os.path.join(opt.global_dir, 'orchestrator_state.json')
+        if os.path.isfile(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+            print(f"[Orchestrator] 由 {self.state_file} 接續，round {self.state['round']}")
+        else:
+            self.state = {'round': 0, 'done': [], 'history': []}
+        self.val_loader = None  # in-process 驗證用的 dataloader，跨輪重用
+
+        # client 抽樣：size / utility 需要各 client 資料量（--sizes 或 data yaml 的 label 數）
+        sizes = opt.sizes
+        if opt.sample in ('size', 'utility') and not sizes:
+            counts = self.state.setdefault('label_counts', {})
+            for c, d in zip(opt.clients, self.data):
+                if str(c) not in counts:
+                    counts[str(c)] = label_count(d)
+            sizes = [counts[str(c)] for c in opt.clients]
+        self.selector = ClientSelector(opt.clients, opt.sample, opt.fraction, sizes, opt.sample_seed, opt.epsilon,
+                                       state=self.state.setdefault('selection', {}))
+
+    def _save_state(self):
+        tmp = f'{self.state_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.state_file)
+
+    def global_path(self, r):
+        return os.path.join(self.opt.global_dir, f'global_round_{r}.pt')
+
+    def run_name(self, c, r):
+        return f'client{c}_r{r}'
+
+    def client_result(self, c, r):
+        return os.path.join(self.opt.client_dir, self.run_name(c, r), 'weights', 'best.pt')
+
+    def start_weights(self, c, r):
+        """
+        client c 在第 r 輪的起始權重（FedBN 時優先使用該 client 自己的 BN 版本）
+        """
+        if r == 0:
+            return ''
+        local = os.path.join(self.opt.global_dir, f'global_round_{r}_client{c}.pt')
+        return local if os.path.isfile(local) else self.global_path(r)
+
+    def train_args(self, c, r):
+        o = self.opt
+        return dict(data=o.data_pattern.format(c), weights=self.start_weights(c, r), cfg=o.cfg, hyp=o.hyp,
+                    epochs=o.epochs, batch_size=o.batch, imgsz=o.img, workers=o.workers,
+                    project=o.client_dir, name=self.run_name(c, r), exist_ok=True)
+
+    def train_inprocess(self, clients, r):
+        import train_dual
+        from utils.dataloaders import release_dataloaders
+        release_dataloaders([self.opt.data_pattern.format(c) for c in clients])  # 只關閉本輪未被選中 client 的 dataloader
+        for c in clients:
+            print(f"[Orchestrator] round {r} client {c}（in-process）")
+            opt = train_dual.parse_opt(True, [])  # 預設值，不解析 orchestrator 自己的 sys.argv
+            for k, v in self.train_args(c, r).items():
+                setattr(opt, k, v)
+            opt.device, opt.keep_loaders = self.opt.device, 2 * len(clients)  # 每個 client 的 train + val
+            train_dual.main(opt, Callbacks())  # 每次新的 Callbacks，避免上一輪的 logger 重複註冊
+            self._mark_done(c, r)
+
+    def train_subprocess(self, clients, r):
+        flags = {'batch_size': '--batch-size', 'imgsz': '--imgsz', 'exist_ok': '--exist-ok'}
+        jobs = []
+        for c in clients:
+            cmd = [sys.executable, 'train_dual.py']
+            for k, v in self.train_args(c, r).items():
+                flag = flags.get(k, f"--{k.replace('_', '-')}")
+                cmd += [flag] if v is True else [flag, str(v)]
+            log = os.path.join(self.opt.client_dir, f'{self.run_name(c, r)}.log')
+            jobs.append((self.run_name(c, r), cmd, log))
+        failed = LocalLauncher(self.opt.devices or [self.opt.device]).run(jobs)
+        for c in clients:
+            if self.run_name(c, r) not in failed:
+                self._mark_done(c, r)
+        if failed:
+            raise RuntimeError(f"{', '.join(failed)} 訓練失敗")
+
+    def select(self, r):
+        """
+        第 r 輪參與的 client；已抽過的輪次（續跑）沿用先前結果
+        """
+        chosen = self.state.setdefault('selected', {})
+        if str(r) not in chosen:
+            for c in chosen.get(str(r - 1), []):
+                self.selector.update_utility(c, final_train_loss(os.path.join(self.opt.client_dir,
+                                                                             self.run_name(c, r - 1))))
+            chosen[str(r)] = self.selector.select(r)
+            self._save_state()
+            print(f"[Orchestrator] round {r} 參與 client（{self.opt.sample}）：{chosen[str(r)]}")
+        return chosen[str(r)]
+
+    def _mark_done(self, c, r):
+        self.state['done'].append(self.run_name(c, r))
+        self._save_state()
+
+    def aggregate(self, clients, r):
+        o = self.opt
+        paths = [self.client_result(c, r) for c in clients]
+        prev = self.global_path(r) if r > 0 else None
+        sizes = [o.sizes[o.clients.index(c)] for c in clients] if o.sizes else None
+        agg_sd = fa.aggregate(paths, sizes=sizes, method=o.method, bn=o.bn, jobs=o.jobs, stream=True,
+                              global_model=prev, server_state=os.path.join(o.global_dir, 'server_state.pt'),
+                              server_round=r)
+        out = self.global_path(r + 1)
+        model = fa.save_global_model(agg_sd, o.cfg, self.nc, out)
+        if o.bn == 'local':
+            fa.save_fedbn_models(model, paths, out, client_ids=clients)
+        print(f"[Orchestrator] round {r} 聚合完成：{out}")
+        return out
+
+    def validate(self, weights):
+        """
+        以 val set 驗證 global 權重；val dataloader 只建立一次
+        """
+        import torch
+        import val_dual as validate
+        from models.experimental import attempt_load
+        from utils.dataloaders import create_dataloader
+        from utils.torch_utils import select_device
+
+        o = self.opt
+        device = select_device(o.device, batch_size=o.val_batch)
+        data_dict = check_dataset(o.val_data)
+        if self.val_loader is None:
+            self.val_loader = create_dataloader(data_dict['val'], o.img, o.val_batch, 32, rect=True, pad=0.5,
+                                                workers=o.workers, prefix=colorstr('val: '))[0]
+        model = attempt_load(weights, device)
+        results, _, _ = validate.run(data_dict, batch_size=o.val_batch, imgsz=o.img, model=model,
+                                     dataloader=self.val_loader, iou_thres=o.iou_thres, plots=False,
+                                     half=device.type != 'cpu')
+        del model
+        torch.cuda.empty_cache()
+        return dict(zip(('P', 'R', 'mAP50', 'mAP50-95'), map(float, results[:4])))
+
+    def run(self):
+        o = self.opt
+        for r in range(self.state['round'], o.rounds):
+            t0 = time.time()
+            selected = self.select(r)
+            clients = [c for c in selected if self.run_name(c, r) not in self.state['done']]
+            if clients:
+                (self.train_inprocess if o.mode == 'inprocess' else self.train_subprocess)(clients, r)
+            out = self.aggregate(selected, r)
+            metrics = {} if o.noval else self.validate(out)
+            self.state['history'].append({'round': r, 'clients': selected, 'global': out, 'metrics': metrics,
+                                          'seconds': round(time.time() - t0, 1)})
+            self.state['round'] = r + 1
+            self._save_state()
+            LOGGER.info(f"[Orchestrator] round {r} 完成 {metrics}")
+
+        final = os.path.join(o.final_dir, f'{o.name}.pt')
+        if self.state['round'] > 0:
+            os.makedirs(o.final_dir, exist_ok=True)
+            shutil.copyfile(self.global_path(self.state['round']), final)
+            print(f"[OK] 聯邦訓練完成，最終權重：{final}")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description='Federated round orchestrator for YOLOv9'
+    )
+    p.add_argument('--clients', nargs='+', type=int, default=[0, 1, 2, 3], help='參與的 client 編號')
+    p.add_argument('--data-pattern', default='data/kitti_client{}.yaml', help='client data yaml，{} 為 client 編號')
+    p.add_argument('--val-data', default='data/kitti_val.yaml', help='global model 驗證用 data yaml')
+    p.add_argument('--rounds', type=int, default=5, help='聯邦輪數')
+    p.add_argument('--epochs', type=int, default=50, help='每輪 client 訓練 epochs')
+    p.add_argument('--batch', type=int, default=16, help='client 訓練 batch size')
+    p.add_argument('--val-batch', type=int, default=8, help='驗證 batch size')
+    p.add_argument('--workers', type=int, default=4, help='dataloader workers')
+    p.add_argument('--img', type=int, default=640, help='影像大小')
+    p.add_argument('--iou-thres', type=float, default=0.65, help='驗證 NMS IoU 門檻')
+    p.add_argument('--cfg', default='models/detect/yolov9-c.yaml', help='YOLOv9 模型配置檔 (.yaml)')
+    p.add_argument('--hyp', default='data/hyps/hyp.scratch-high.yaml', help='超參數 yaml')
+    p.add_argument('--mode', default='inprocess', choices=['inprocess', 'subprocess'], help='client 執行方式')
+    p.add_argument('--device', default='0', help='in-process 訓練與驗證使用的 device')
+    p.add_argument('--devices', nargs='+', help='subprocess 模式的 GPU slot（預設為 --device）')
+    p.add_argument('-m','--method', default='fedavg', choices=fa.METHODS, help='聚合策略')
+    p.add_argument('--bn', default='avg', choices=fa.BN_MODES, help='BatchNorm 聚合方式')
+    p.add_argument('-s','--sizes', nargs='+', type=int, help='各 client 樣本數（與 --clients 同順序）')
+    p.add_argument('-j','--jobs', type=int, default=1, help='平行解碼 client 權重的 process 數')
+    p.add_argument('--sample', default='all', choices=SELECT_METHODS, help='每輪 client 抽樣方式')
+    p.add_argument('--fraction', type=float, default=1.0, help='每輪參與的 client 比例')
+    p.add_argument('--epsilon', type=float, default=0.2, help='utility 抽樣中保留給探索的比例')
+    p.add_argument('--sample-seed', type=int, default=0, help='抽樣亂數種子')
+    p.add_argument('--noval', action='store_true', help='每輪不驗證 global model')
+    p.add_argument('--client-dir', default='fed_client_weights', help='client 訓練輸出目錄')
+    p.add_argument('--global-dir', default='global_round_weights', help='global 權重與輪次狀態目錄')
+    p.add_argument('--final-dir', default='fed_final_weights', help='最終權重目錄')
+    p.add_argument('--name', help='最終權重檔名（預設 R{rounds}E{epochs}_orchestrated）')
+    opt = p.parse_args()
+    opt.name = opt.name or f'R{opt.rounds}E{opt.epochs}_orchestrated'
+    if opt.sizes and len(opt.sizes) != len(opt.clients):
+        p.error('--sizes 長度必須等於 --clients')
+    return opt
+
+
+def main():
+    opt = parse_args()
+    for f in [opt.data_pattern.format(c) for c in opt.clients] + [opt.cfg]:
+        if not os.path.isfile(f):
+            sys.stderr.write(f"[ERROR] 找不到檔案: {f}\n")
+            sys.exit(1)
+    FedOrchestrator(opt).run()
+
+
+if __name__ == '__main__':
+    main()
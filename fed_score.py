@@ -1,145 +1,261 @@
 #!/usr/bin/env python3
 # usage:
 #   python tools/eval_map50_from_txt.py \
-#     --pred /home/xxx/yolov9/runs/fed_val_central/fed_val_central/labels \
+#     --pred /home/xxx/yolov9/runs/fed_val_central/fed_val_central/predictions.npz \
 #     --gt   /home/xxx/yolov9/datasets/kitti/client/val/labels \
 #     --nc 8 \
 #     --names Car Van Truck Pedestrian Person_sitting Cyclist Tram Misc
+# --pred 也可指定 val_dual_2.py --save-format txt 輸出的 labels/ 目錄
 
-import os, glob, argparse, math
-from collections import defaultdict
+import os, glob, argparse, math, shutil, struct, zipfile
 import numpy as np
 
+IOU_THRS = np.linspace(0.5, 0.95, 10)  # mAP@0.5:0.95
+
+# 列式預測檔 (.npz，未壓縮)：每個欄位一個 .npy，可直接 memory-map
+PRED_COLUMNS = {'img': (np.int32, ()), 'cls': (np.int32, ()), 'conf': (np.float32, ()), 'xyxy': (np.float32, (4,))}
+
 def yolo_xywh_to_xyxy(xywh):
-    x,y,w,h = xywh
-    x1 = x - w/2
-    y1 = y - h/2
-    x2 = x + w/2
-    y2 = y + h/2
-    return np.array([x1,y1,x2,y2], dtype=float)
-
-def iou_xyxy(box, boxes):
-    # box: (4,), boxes: (N,4); all in normalized [0,1]
-    if boxes.size == 0: return np.zeros((0,))
-    inter_x1 = np.maximum(box[0], boxes[:,0])
-    inter_y1 = np.maximum(box[1], boxes[:,1])
-    inter_x2 = np.minimum(box[2], boxes[:,2])
-    inter_y2 = np.minimum(box[3], boxes[:,3])
-    inter_w = np.clip(inter_x2 - inter_x1, 0.0, 1.0)
-    inter_h = np.clip(inter_y2 - inter_y1, 0.0, 1.0)
+    # xywh: (..., 4) 陣列
+    xywh = np.asarray(xywh, dtype=float)
+    xyxy = np.empty_like(xywh)
+    xyxy[..., :2] = xywh[..., :2] - xywh[..., 2:4] / 2
+    xyxy[..., 2:] = xywh[..., :2] + xywh[..., 2:4] / 2
+    return xyxy
+
+def iou_pairs(a, b):
+    # a, b: (N,4) 逐列配對計算 IoU；all in normalized [0,1]
+    inter_w = np.clip(np.minimum(a[:,2], b[:,2]) - np.maximum(a[:,0], b[:,0]), 0.0, 1.0)
+    inter_h = np.clip(np.minimum(a[:,3], b[:,3]) - np.maximum(a[:,1], b[:,1]), 0.0, 1.0)
     inter = inter_w * inter_h
-    area1 = (box[2]-box[0]) * (box[3]-box[1])
-    area2 = (boxes[:,2]-boxes[:,0]) * (boxes[:,3]-boxes[:,1])
+    area1 = (a[:,2]-a[:,0]) * (a[:,3]-a[:,1])
+    area2 = (b[:,2]-b[:,0]) * (b[:,3]-b[:,1])
     union = area1 + area2 - inter + 1e-16
     return inter / union
 
 def voc_ap(rec, prec):
-    
     mrec = np.concatenate(([0.0], rec, [1.0]))
     mpre = np.concatenate(([0.0], prec, [0.0]))
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i-1] = max(mpre[i-1], mpre[i])
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))  # precision envelope
     idx = np.where(mrec[1:] != mrec[:-1])[0] + 1
     ap = np.sum((mrec[idx] - mrec[idx-1]) * mpre[idx])
     return ap
 
-def load_gt(gt_dir, nc):
-    gt = defaultdict(lambda: defaultdict(list)) # img -> class -> [xyxy...]
-    npos = np.zeros(nc, dtype=int)
+def _read_rows(p, ncol):
+    # 回傳 list of token lists；各行欄位數相同時走 numpy 快速路徑
+    with open(p) as f:
+        text = f.read()
+    lines = [q for q in (line.split() for line in text.splitlines()) if q]
+    if lines and all(len(q) == ncol for q in lines):
+        return np.array(text.split(), dtype=float).reshape(-1, ncol)
+    return lines
+
+def load_gt(gt_dir, nc, img_ids=None):
+    """
+    回傳 GT 陣列 dict(img, cls, xyxy) 與每類 GT 數 npos；img_ids: 影像名稱 -> 整數 id（就地擴充）
+    """
+    img_ids = {} if img_ids is None else img_ids
+    imgs, rows = [], []
     for p in sorted(glob.glob(os.path.join(gt_dir, '*.txt'))):
-        img = os.path.splitext(os.path.basename(p))[0]
-        arr = []
-        with open(p) as f:
-            for line in f:
-                q = line.strip().split()
-                if len(q) < 5: continue
-                c = int(float(q[0]))
-                if c < 0 or c >= nc: continue
-                xywh = list(map(float, q[1:5]))
-                xyxy = yolo_xywh_to_xyxy(xywh)
-                gt[img][c].append(xyxy)
-                npos[c] += 1
-    # convert lists to arrays
-    for img in gt:
-        for c in list(gt[img].keys()):
-            gt[img][c] = np.stack(gt[img][c], axis=0) if gt[img][c] else np.zeros((0,4))
-    return gt, npos
-
-def load_pred(pred_dir, nc):
-    # 返回 list: (img, class, conf, xyxy)
-    preds = []
+        img = img_ids.setdefault(os.path.splitext(os.path.basename(p))[0], len(img_ids))
+        r = _read_rows(p, 5)
+        if not isinstance(r, np.ndarray):  # 欄位數不一（例如含 segment），逐行取前 5 欄
+            r = np.array([list(map(float, q[:5])) for q in r if len(q) >= 5], dtype=float).reshape(-1, 5)
+        imgs.append(np.full(len(r), img))
+        rows.append(r)
+    r = np.concatenate(rows) if rows else np.zeros((0,5))
+    img = np.concatenate(imgs).astype(int) if imgs else np.zeros(0, dtype=int)
+    c = r[:,0].astype(int)
+    keep = (c >= 0) & (c < nc)
+    gt = dict(img=img[keep], cls=c[keep], xyxy=yolo_xywh_to_xyxy(r[keep,1:5]))
+    npos = np.bincount(gt['cls'], minlength=nc)
+    return gt, npos, img_ids
+
+def load_pred(pred_dir, nc, img_ids):
+    """
+    回傳預測陣列 dict(img, cls, conf, xyxy)，依 conf 降序（stable）排列
+    """
+    imgs, rows = [], []
     for p in sorted(glob.glob(os.path.join(pred_dir, '*.txt'))):
-        img = os.path.splitext(os.path.basename(p))[0]
-        with open(p) as f:
-            for line in f:
-                q = line.strip().split()
-                if len(q) < 6:  # 需要有 conf
-                    # 某些版本是 5 列（没有 conf）
-                    q += ['0.001']
-                c = int(float(q[0]))
-                if c < 0 or c >= nc: continue
-                xywh = list(map(float, q[1:5]))
-                conf = float(q[5])
-                xyxy = yolo_xywh_to_xyxy(xywh)
-                preds.append((img, c, conf, xyxy))
-    # 依 conf 降序
-    preds.sort(key=lambda x: x[2], reverse=True)
-    return preds
+        img = img_ids.setdefault(os.path.splitext(os.path.basename(p))[0], len(img_ids))
+        r = _read_rows(p, 6)
+        if not isinstance(r, np.ndarray):
+            # 某些版本是 5 列（没有 conf）
+            r = np.array([list(map(float, (q + ['0.001'])[:6])) for q in r if len(q) >= 5],
+                         dtype=float).reshape(-1, 6)
+        imgs.append(np.full(len(r), img))
+        rows.append(r)
+    r = np.concatenate(rows) if rows else np.zeros((0,6))
+    img = np.concatenate(imgs).astype(int) if imgs else np.zeros(0, dtype=int)
+    return _sorted_preds(img, r[:,0].astype(int), r[:,5], yolo_xywh_to_xyxy(r[:,1:5]), nc)
 
-def eval_map50(preds, gt, npos, iou_thr=0.5, nc=8):
-    aps = np.zeros(nc)
-    per_cls = {}
-    for c in range(nc):
-        # 收集該類別的所有預測
-        preds_c = [(img,conf,box) for (img,cc,conf,box) in preds if cc==c]
-        if npos[c] == 0:
-            per_cls[c] = dict(AP=np.nan, P=np.nan, R=np.nan)
-            continue
-        tp = np.zeros(len(preds_c))
-        fp = np.zeros(len(preds_c))
-        matched = defaultdict(lambda: np.array([]))  # img -> 已匹配的 GT 索引
-        # 逐預測匹配
-        for i,(img,conf,box) in enumerate(preds_c):
-            gtc = gt.get(img, {}).get(c, np.zeros((0,4)))
-            if gtc.shape[0] == 0:
-                fp[i] = 1
+def _sorted_preds(img, cls, conf, xyxy, nc):
+    # 過濾類別範圍並依 conf 降序（stable）排列
+    keep = (cls >= 0) & (cls < nc)
+    img, cls, conf, xyxy = img[keep], cls[keep], conf[keep], xyxy[keep]
+    order = np.argsort(-conf, kind='stable')
+    return dict(img=img[order], cls=cls[order], conf=conf[order], xyxy=xyxy[order])
+
+class PredStoreWriter:
+    """
+    依 batch 寫入列式預測檔：add() 暫存、flush() 追加到各欄位暫存檔、close() 組成未壓縮 .npz
+    xyxy 為 normalized [0,1] 座標，img 為影像 id（對應 names 欄位的影像名稱）
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.tmp = {k: open(f'{self.path}.{k}.tmp', 'wb') for k in PRED_COLUMNS}
+        self.names, self.buf, self.n = [], {k: [] for k in PRED_COLUMNS}, 0
+
+    def add(self, name, cls, conf, xyxy):
+        img = len(self.names)
+        self.names.append(name)
+        for k, v in (('img', np.full(len(cls), img)), ('cls', cls), ('conf', conf), ('xyxy', xyxy)):
+            self.buf[k].append(np.asarray(v, dtype=PRED_COLUMNS[k][0]).reshape((-1,) + PRED_COLUMNS[k][1]))
+
+    def flush(self):
+        if self.buf['img']:
+            for k, f in self.tmp.items():
+                a = np.concatenate(self.buf[k])
+                a.tofile(f)
+                self.buf[k] = []
+            self.n += len(a)
+
+    def close(self):
+        self.flush()
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for k, f in self.tmp.items():
+                f.close()
+                dtype, shape = PRED_COLUMNS[k]
+                with zf.open(f'{k}.npy', 'w', force_zip64=True) as out, open(f.name, 'rb') as src:
+                    np.lib.format.write_array_header_2_0(
+                        out, {'descr': np.dtype(dtype).str, 'fortran_order': False, 'shape': (self.n,) + shape})
+                    shutil.copyfileobj(src, out)
+                os.remove(f.name)
+            with zf.open('names.npy', 'w', force_zip64=True) as out:
+                np.lib.format.write_array(out, np.array(self.names, dtype=str))
+        return self.path
+
+def load_pred_store(path):
+    """
+    memory-map 未壓縮 .npz 中的各欄位（壓縮過的成員則退回一般讀取）
+    """
+    out = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as fp:
+        for zi in zf.infolist():
+            k = zi.filename[:-4]
+            if zi.compress_type != zipfile.ZIP_STORED:
+                with zf.open(zi) as f:
+                    out[k] = np.lib.format.read_array(f)
                 continue
-            ious = iou_xyxy(box, gtc)
-            j = int(np.argmax(ious)) if ious.size else -1
-            iou = ious[j] if j>=0 else 0.0
-            if iou >= iou_thr:
-                # 防止一個 GT 被重複匹配
-                if matched[img].size == 0:
-                    matched[img] = -np.ones(gtc.shape[0], dtype=int)
-                if matched[img][j] == -1:
-                    tp[i] = 1
-                    matched[img][j] = i
-                else:
-                    fp[i] = 1
+            # local file header：30 bytes + 檔名 + extra field，之後即為 .npy 內容
+            fp.seek(zi.header_offset)
+            n_name, n_extra = struct.unpack('<HH', fp.read(30)[26:30])
+            fp.seek(zi.header_offset + 30 + n_name + n_extra)
+            version = np.lib.format.read_magic(fp)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(fp)
+            if dtype.hasobject or not all(shape):
+                fp.seek(zi.header_offset + 30 + n_name + n_extra)
+                out[k] = np.lib.format.read_array(fp)
             else:
-                fp[i] = 1
-        # PR & AP
-        cum_tp = np.cumsum(tp)
-        cum_fp = np.cumsum(fp)
-        rec = cum_tp / (npos[c] + 1e-16)
-        prec = cum_tp / np.maximum(cum_tp + cum_fp, 1e-16)
-        ap = voc_ap(rec, prec)
-        aps[c] = ap
-        per_cls[c] = dict(AP=ap, P=prec[-1], R=rec[-1])
-    mAP = np.nanmean(aps[np.logical_not(np.isnan(aps))]) if np.any(~np.isnan(aps)) else 0.0
+                out[k] = np.memmap(path, dtype=dtype, mode='r', offset=fp.tell(), shape=shape,
+                                   order='F' if fortran_order else 'C')
+    return out
+
+def load_pred_npz(path, nc, img_ids):
+    """
+    讀取 PredStoreWriter 輸出的 .npz，回傳格式同 load_pred()
+    """
+    store = load_pred_store(path)
+    remap = np.array([img_ids.setdefault(str(n), len(img_ids)) for n in store['names']], dtype=int)
+    img = remap[store['img']] if len(remap) else np.zeros(0, dtype=int)
+    return _sorted_preds(img, np.asarray(store['cls'], dtype=int), np.asarray(store['conf'], dtype=float),
+                         np.asarray(store['xyxy'], dtype=float), nc)
+
+def match_preds(preds, gt, nc):
+    """
+    每個預測與同 (影像, 類別) 的 GT 做 batched IoU，回傳 (最大 IoU, 對應 GT 全域索引；無 GT 時為 -1)
+    """
+    n = len(preds['cls'])
+    gkey = gt['img'] * nc + gt['cls']
+    gorder = np.argsort(gkey, kind='stable')  # 同組內維持檔案中的 GT 順序
+    gkey_sorted = gkey[gorder]
+    pkey = preds['img'] * nc + preds['cls']
+    start = np.searchsorted(gkey_sorted, pkey, side='left')
+    cnt = np.searchsorted(gkey_sorted, pkey, side='right') - start
+
+    # 展開所有 (pred, gt) 配對
+    pair_pred = np.repeat(np.arange(n), cnt)
+    offset = np.arange(len(pair_pred)) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+    pair_gt = gorder[np.repeat(start, cnt) + offset]
+    ious = iou_pairs(preds['xyxy'][pair_pred], gt['xyxy'][pair_gt])
+
+    best_iou = np.zeros(n)
+    best_gt = -np.ones(n, dtype=int)
+    has = cnt > 0
+    if has.any():
+        seg = np.cumsum(cnt) - cnt
+        best_iou[has] = np.maximum.reduceat(ious, seg[has])
+        # argmax：每個預測取第一個達到最大值的 GT
+        hit = ious == best_iou[pair_pred]
+        first = np.unique(pair_pred[hit], return_index=True)[1]
+        best_gt[pair_pred[hit][first]] = pair_gt[hit][first]
+    return best_iou, best_gt
+
+def eval_map(preds, gt, npos, iou_thrs=(0.5,), nc=8):
+    """
+    向量化 mAP：回傳 aps (nc, len(iou_thrs))；per_cls 為第一個門檻的 AP/P/R（無 GT 的類別為 nan）
+    每個預測與 IoU 最大的 GT 比對，該 GT 尚未被更高 conf 的預測匹配且 IoU >= 門檻時為 TP
+    """
+    best_iou, best_gt = match_preds(preds, gt, nc)
+    aps = np.zeros((nc, len(iou_thrs)))
+    per_cls = {}
+    for t, thr in enumerate(iou_thrs):
+        ok = (best_gt >= 0) & (best_iou >= thr)
+        tp = np.zeros(len(ok), dtype=bool)
+        # 同一個 GT 只有 conf 最高（排序最前）的預測算 TP
+        first = np.unique(best_gt[ok], return_index=True)[1]
+        tp[np.flatnonzero(ok)[first]] = True
+        for c in range(nc):
+            if npos[c] == 0:
+                if t == 0:
+                    per_cls[c] = dict(AP=np.nan, P=np.nan, R=np.nan)
+                continue
+            tpc = tp[preds['cls'] == c]
+            cum_tp = np.cumsum(tpc)
+            cum_fp = np.cumsum(~tpc)
+            rec = cum_tp / (npos[c] + 1e-16)
+            prec = cum_tp / np.maximum(cum_tp + cum_fp, 1e-16)
+            aps[c, t] = voc_ap(rec, prec)
+            if t == 0:
+                per_cls[c] = dict(AP=aps[c, t], P=prec[-1] if len(prec) else 0.0, R=rec[-1] if len(rec) else 0.0)
+    return aps, per_cls
+
+def eval_map50(preds, gt, npos, iou_thr=0.5, nc=8):
+    aps, per_cls = eval_map(preds, gt, npos, iou_thrs=(iou_thr,), nc=nc)
+    aps = aps[:, 0]
+    mAP = np.nanmean(aps) if np.any(~np.isnan(aps)) else 0.0
     return mAP, aps, per_cls
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument('--pred', required=True, help='pred txt dir (YOLO, with conf)')
+    ap.add_argument('--pred', required=True, help='pred txt dir (YOLO, with conf) or predictions .npz')
     ap.add_argument('--gt',   required=True, help='GT txt dir (YOLO)')
     ap.add_argument('--nc',   type=int, required=True, help='num classes')
     ap.add_argument('--names', nargs='*', default=None, help='class names (optional)')
     args = ap.parse_args()
 
-    gt, npos = load_gt(args.gt, args.nc)
-    preds = load_pred(args.pred, args.nc)
-    mAP, aps, per_cls = eval_map50(preds, gt, npos, iou_thr=0.5, nc=args.nc)
+    gt, npos, img_ids = load_gt(args.gt, args.nc)
+    if os.path.isfile(args.pred) and args.pred.endswith('.npz'):
+        preds = load_pred_npz(args.pred, args.nc, img_ids)
+    else:
+        preds = load_pred(args.pred, args.nc, img_ids)
+    aps_all, per_cls = eval_map(preds, gt, npos, iou_thrs=IOU_THRS, nc=args.nc)
+    aps = aps_all[:, 0]
+    mAP = np.nanmean(aps) if np.any(~np.isnan(aps)) else 0.0
+    mAP5095 = np.nanmean(aps_all) if np.any(~np.isnan(aps_all)) else 0.0
 
     names = args.names if args.names and len(args.names)==args.nc else [f'cls{i}' for i in range(args.nc)]
     print('---------- Results (IoU=0.5) ----------')
@@ -149,12 +265,14 @@ def main():
         else:
             print(f'{names[i]:<16} AP: {apv*100:6.2f}%')
     print(f'===> mAP@0.5: {mAP*100:.2f}%')
+    print(f'===> mAP@0.5:0.95: {mAP5095*100:.2f}%')
 
     # 寫到結果檔
     save_dir = os.path.dirname(os.path.abspath(args.pred))
     out = os.path.join(save_dir, 'results.txt')
     with open(out, 'w') as f:
         f.write(f'mAP@0.5: {mAP*100:.4f}%\n')
+        f.write(f'mAP@0.5:0.95: {mAP5095*100:.4f}%\n')
         for i, apv in enumerate(aps):
             if math.isnan(apv):
                 f.write(f'{names[i]}: -\n')
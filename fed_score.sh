@@ -65,7 +65,7 @@ NBatch=32    # v100 超過 254會failed
 
 ## 訓練 train_dual.py 命令 (動態設置 nproc_per_node 和 nnodes)
 TRAIN_CMD="python fed_score.py \
-             --pred fed_val_central/fed_val_central/labels \
+             --pred fed_val_central/fed_val_central/predictions.npz \
              --gt datasets/kitti/client/val/labels \
              --nc 8 \
              --names Car Van Truck Pedestrian Person_sitting Cyclist Tram Misc"
@@ -0,0 +1,193 @@
+# fed_select.py
+# 每輪 client 抽樣（partial participation）：uniform / 依資料量 / 依 loss utility（Oort）
+
+# +
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Client selection for Federated YOLOv9
+每輪只讓 fraction 比例的 client 參與訓練，降低單輪成本：
+  all     : 全部 client（原本 run_aggregate.sh 的行為）
+  uniform : 均勻隨機抽樣
+  size    : 依資料量（data/kitti_client*.yaml 的 label 數）加權、不重複抽樣
+  utility : Oort 風格，statistical utility = label 數 x 最後一個 epoch 的 train loss，
+            加上久未被選中的 staleness bonus，並保留 epsilon 比例探索尚未參與過的 client
+參與紀錄存於 state json（預設 global_round_weights/selection_state.json）。
+
+用法（shell pipeline）:
+    CLIENTS=$(python fed_select.py --round ${ROUND} --method size --fraction 0.5)
+"""
+import os
+import sys
+import json
+import math
+import glob
+import random
+import argparse
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from utils.dataloaders import IMG_FORMATS, img2label_paths
+
+SELECT_METHODS = ['all', 'uniform', 'size', 'utility']
+
+
+def label_count(data):
+    """
+    計算 data yaml 中 train split 的 label（物件）數量
+    """
+    with open(data, errors='ignore') as f:
+        d = yaml.safe_load(f)
+    root = Path(d.get('path') or '')
+    im_files = []
+    for p in d['train'] if isinstance(d['train'], list) else [d['train']]:
+        p = Path(p) if Path(p).is_absolute() else root / p
+        if p.is_dir():
+            im_files += glob.glob(str(p / '**' / '*.*'), recursive=True)
+        elif p.is_file():  # txt 檔列出影像路徑
+            with open(p) as f:
+                im_files += [x.strip() for x in f.read().strip().splitlines()]
+    im_files = [x for x in im_files if x.split('.')[-1].lower() in IMG_FORMATS]
+    n = 0
+    for lb in img2label_paths(im_files):
+        if os.path.isfile(lb):
+            with open(lb) as f:
+                n += sum(1 for line in f if line.strip())
+    return n
+
+
+def final_train_loss(run_dir):
+    """
+    讀取 train_dual.py 輸出的 results.csv，回傳最後一個 epoch 的 train loss 總和；不存在時回傳 None
+    """
+    f = os.path.join(run_dir, 'results.csv')
+    if not os.path.isfile(f):
+        return None
+    with open(f) as fp:
+        rows = [[x.strip() for x in line.split(',')] for line in fp if line.strip()]
+    if len(rows) < 2:
+        return None
+    return sum(float(v) for k, v in zip(rows[0], rows[-1]) if k.startswith('train/'))
+
+
+class ClientSelector:
+    """
+    每輪 client 抽樣；state 為可 json 化的 dict（participation / utility），跨輪保存
+    """
+
+    def __init__(self, clients, method='all', fraction=1.0, sizes=None, seed=0, epsilon=0.2, state=None):
+        self.clients = list(clients)
+        self.method = method
+        self.k = max(1, min(len(self.clients), round(fraction * len(self.clients))))
+        self.sizes = sizes
+        self.seed = seed
+        self.epsilon = epsilon
+        self.state = state if state is not None else {}
+        self.state.setdefault('participation', {})
+        self.state.setdefault('utility', {})
+        if method in ('size', 'utility') and not sizes:
+            raise ValueError(f"method={method} 需要各 client 的資料量 (sizes)")
+
+    def select(self, r):
+        """
+        回傳第 r 輪參與的 client（以 seed + r 決定亂數，續跑時結果相同）
+        """
+        rng = random.Random(self.seed + r)
+        if self.method == 'all' or self.k == len(self.clients):
+            selected = list(self.clients)
+        elif self.method == 'uniform':
+            selected = rng.sample(self.clients, self.k)
+        elif self.method == 'size':
+            p = np.array(self.sizes, dtype=float)
+            p = p / p.sum()
+            idx = np.random.default_rng(self.seed + r).choice(len(self.clients), self.k, replace=False, p=p)
+            selected = [self.clients[i] for i in idx]
+        else:
+            selected = self._select_utility(r, rng)
+        selected = sorted(selected)
+        for c in selected:
+            self.state['participation'].setdefault(str(c), []).append(r)
+        return selected
+
+    def _select_utility(self, r, rng):
+        util = self.state['utility']
+        unexplored = [c for c in self.clients if str(c) not in util]
+        explored = [c for c in self.clients if str(c) in util]
+        n_explore = min(len(unexplored), max(math.ceil(self.epsilon * self.k), self.k - len(explored)))
+        selected = rng.sample(unexplored, n_explore)
+
+        # exploitation：正規化 utility + staleness bonus sqrt(0.1 * log(r) / L_i)，L_i 為上次被選中的輪次
+        u_max = max((util[str(c)] for c in explored), default=1.0) or 1.0
+
+        def score(c):
+            last = max(self.state['participation'].get(str(c), [0]))
+            return util[str(c)] / u_max + math.sqrt(0.1 * math.log(r + 1) / (last + 1))
+
+        selected += sorted(explored, key=score, reverse=True)[:self.k - n_explore]
+        return selected
+
+    def update_utility(self, c, loss):
+        """
+        以 client 本輪訓練後的 loss 更新其 statistical utility = 資料量 x loss
+        """
+        if self.method == 'utility' and loss is not None:  # 其他抽樣方式不一定有 sizes
+            self.state['utility'][str(c)] = self.sizes[self.clients.index(c)] * loss
+
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description='Client selection for Federated YOLOv9'
+    )
+    p.add_argument('--round', type=int, required=True, help='本輪輪次 R')
+    p.add_argument('--clients', nargs='+', type=int, default=[0, 1, 2, 3], help='所有 client 編號')
+    p.add_argument('--data-pattern', default='data/kitti_client{}.yaml', help='client data yaml，{} 為 client 編號')
+    p.add_argument('--method', default='all', choices=SELECT_METHODS, help='抽樣方式')
+    p.add_argument('--fraction', type=float, default=1.0, help='每輪參與比例')
+    p.add_argument('--epsilon', type=float, default=0.2, help='utility 抽樣中保留給探索的比例')
+    p.add_argument('--seed', type=int, default=0, help='抽樣亂數種子')
+    p.add_argument('--client-dir', default='fed_client_weights', help='client 訓練輸出目錄（讀取上一輪 loss）')
+    p.add_argument('--state', default='global_round_weights/selection_state.json', help='參與紀錄檔')
+    return p.parse_args()
+
+
+def main():
+    opt = parse_args()
+    state = {}
+    if os.path.isfile(opt.state):
+        with open(opt.state) as f:
+            state = json.load(f)
+    if str(opt.round) in state.get('selected', {}):
+        print(' '.join(map(str, state['selected'][str(opt.round)])))  # 同一輪重複查詢回傳相同結果
+        return
+
+    sizes = None
+    if opt.method in ('size', 'utility'):
+        counts = state.setdefault('label_counts', {})
+        for c in opt.clients:
+            if str(c) not in counts:
+                counts[str(c)] = label_count(opt.data_pattern.format(c))
+        sizes = [counts[str(c)] for c in opt.clients]
+    try:
+        selector = ClientSelector(opt.clients, opt.method, opt.fraction, sizes, opt.seed, opt.epsilon, state)
+    except ValueError as e:
+        sys.stderr.write(f"[ERROR] {e}\n")
+        sys.exit(1)
+
+    # 上一輪參與者的 loss 更新 utility
+    prev = state.get('selected', {}).get(str(opt.round - 1), [])
+    for c in prev:
+        selector.update_utility(c, final_train_loss(os.path.join(opt.client_dir, f'client{c}_r{opt.round - 1}')))
+
+    selected = selector.select(opt.round)
+    state.setdefault('selected', {})[str(opt.round)] = selected
+    os.makedirs(os.path.dirname(os.path.abspath(opt.state)), exist_ok=True)
+    with open(opt.state, 'w') as f:
+        json.dump(state, f, indent=2)
+    sys.stderr.write(f"[Select] round {opt.round} ({opt.method}, {len(selected)}/{len(opt.clients)}): {selected}\n")
+    print(' '.join(map(str, selected)))
+
+
+if __name__ == '__main__':
+    main()
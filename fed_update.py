@@ -0,0 +1,183 @@
+# fed_update.py
+# Client 端壓縮更新檔：只傳送相對 global_round_{R}.pt 的權重差 (delta)
+
+# +
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Client 更新壓縮 for Federated YOLOv9
+將 train_dual.py 輸出的 best.pt（model + EMA + optimizer）轉成只含權重差的精簡更新檔，
+可選 fp16 / int8 量化、top-k 稀疏化，以及 error feedback（未傳送的殘差累積到下一輪）。
+fed_aggregate.py 可直接讀取此格式（需提供 --global-model 作為 base）。
+
+用法:
+    python fed_update.py \\
+      -w fed_client_weights/client0_r1/weights/best.pt \\
+      -b global_round_weights/global_round_1.pt \\
+      -o fed_client_weights/client0_r1/weights/update.pt \\
+      --quant int8 --topk 0.1 \\
+      --residual fed_client_weights/client0_residual.pt
+"""
+import os
+import sys
+import argparse
+import torch
+
+from fed_aggregate import load_state_dict
+
+UPDATE_FORMAT = 'fed_update_v1'
+QUANT_MODES = ['none', 'fp16', 'int8']
+
+
+def is_update(ckpt):
+    """
+    判斷 torch.load 結果是否為 fed_update 格式
+    """
+    return isinstance(ckpt, dict) and ckpt.get('format') == UPDATE_FORMAT
+
+
+def encode_tensor(x, quant='none', topk=None):
+    """
+    壓縮單一 float32 tensor，回傳 (encoded dict, 解碼後的近似值)
+    topk: 保留絕對值最大的比例 (0, 1]；quant: none / fp16 / int8（per-tensor 對稱量化）
+    """
+    flat = x.reshape(-1)
+    idx = None
+    if topk is not None and topk < 1.0 and flat.numel() > 1:
+        k = max(1, int(flat.numel() * topk))
+        idx = flat.abs().topk(k, sorted=False).indices.sort().values
+        values = flat[idx]
+    else:
+        values = flat
+
+    scale = None
+    if quant == 'fp16':
+        q = values.half()
+        deq = q.float()
+    elif quant == 'int8':
+        scale = values.abs().max().item() / 127 if values.numel() else 0.0
+        q = (values / scale).round().clamp_(-127, 127).to(torch.int8) if scale > 0 else \
+            torch.zeros_like(values, dtype=torch.int8)
+        deq = q.float() * scale
+    else:
+        q = values.clone()
+        deq = q
+
+    approx = torch.zeros_like(flat)
+    if idx is None:
+        approx.copy_(deq)
+    else:
+        approx[idx] = deq
+    enc = {'shape': tuple(x.shape), 'values': q, 'scale': scale,
+           'idx': None if idx is None else idx.int()}
+    return enc, approx.view_as(x)
+
+
+def decode_tensor(enc):
+    """
+    還原 encode_tensor() 的結果為 float32 tensor
+    """
+    values = enc['values'].float()
+    if enc['scale'] is not None:
+        values = values * enc['scale']
+    numel = 1
+    for s in enc['shape']:
+        numel *= s
+    if enc['idx'] is None:
+        return values.reshape(enc['shape'])
+    out = torch.zeros(numel, dtype=torch.float32)
+    out[enc['idx'].long()] = values
+    return out.view(enc['shape'])
+
+
+def encode_update(sd, base_sd=None, quant='none', topk=None, residual=None):
+    """
+    對 base_sd 做差並壓縮；浮點 tensor 存 delta，其他（如 num_batches_tracked）原樣保存
+    residual: error feedback 殘差（上一輪未傳送的部分），回傳更新後的殘差
+    """
+    delta, full, new_residual = {}, {}, {}
+    for k, v in sd.items():
+        if not isinstance(v, torch.Tensor):
+            continue
+        if not v.is_floating_point():
+            full[k] = v.clone()
+            continue
+        d = v.float()
+        if base_sd is not None and k in base_sd:
+            d = d - base_sd[k].float()
+        if residual is not None and k in residual:
+            d = d + residual[k]
+        delta[k], approx = encode_tensor(d, quant=quant, topk=topk)
+        new_residual[k] = d - approx
+    update = {'format': UPDATE_FORMAT, 'has_base': base_sd is not None,
+              'quant': quant, 'topk': topk, 'delta': delta, 'full': full}
+    return update, new_residual
+
+
+def decode_update(update, base_sd=None):
+    """
+    還原更新檔為完整 state_dict（base + delta）
+    """
+    if update['has_base'] and base_sd is None:
+        raise ValueError("此更新檔為 delta 格式，需提供 base（上一輪 global 權重）")
+    sd = {}
+    for k, enc in update['delta'].items():
+        d = decode_tensor(enc)
+        sd[k] = base_sd[k].float() + d if update['has_base'] and k in base_sd else d
+    sd.update(update['full'])
+    return sd
+
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description='Client 更新壓縮 for Federated YOLOv9'
+    )
+    p.add_argument(
+        '-w','--weights', required=True,
+        help='Client 訓練輸出的權重 (.pt)'
+    )
+    p.add_argument(
+        '-b','--base',
+        help='本輪起始的 global 權重 (global_round_{R}.pt)；省略時存完整權重'
+    )
+    p.add_argument(
+        '-o','--output', required=True,
+        help='輸出更新檔 (.pt)'
+    )
+    p.add_argument('--quant', default='none', choices=QUANT_MODES, help='delta 量化方式')
+    p.add_argument('--topk', type=float, help='top-k 稀疏化保留比例 (0, 1]')
+    p.add_argument(
+        '--residual',
+        help='error feedback 殘差檔，讀取上一輪殘差並寫回本輪殘差（每個 client 一個檔案）'
+    )
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    for f in [args.weights] + ([args.base] if args.base else []):
+        if not os.path.isfile(f):
+            sys.stderr.write(f"[ERROR] 找不到檔案: {f}\n")
+            sys.exit(1)
+    if args.topk is not None and not 0 < args.topk <= 1:
+        sys.stderr.write(f"[ERROR] --topk 必須介於 (0, 1]: {args.topk}\n")
+        sys.exit(1)
+
+    sd = load_state_dict(args.weights)
+    base_sd = load_state_dict(args.base) if args.base else None
+    residual = None
+    if args.residual and os.path.isfile(args.residual):
+        residual = torch.load(args.residual, map_location='cpu')
+
+    update, residual = encode_update(sd, base_sd, quant=args.quant, topk=args.topk, residual=residual)
+    torch.save(update, args.output)
+    if args.residual:
+        torch.save(residual, args.residual)
+
+    mb = lambda f: os.path.getsize(f) / 1E6
+    print(f"[OK] 更新檔輸出: {args.output} ({mb(args.weights):.1f} MB -> {mb(args.output):.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -15,16 +15,22 @@ if [ -z "$ROUND" ]; then
 fi
 
 NEXT_ROUND=$((ROUND + 1))
+# 聚合策略：fedavg / fedavgm / fedadam / fedyogi / median / trimmed_mean
+METHOD=${METHOD:-fedavg}
+# BatchNorm 聚合：avg / pooled / local (FedBN)
+BN=${BN:-avg}
 
 
-# 準備四個 client 的權重路徑
+# 本輪參與的 client（預設全部；partial participation 可用 fed_select.py 產生）
+# 例如: CLIENTS="$(python fed_select.py --round ${ROUND} --method size --fraction 0.5)" ./run_aggregate.sh ${ROUND}
 cd /home/your_account/yolov9
-INPUT_MODELS=(
-  "fed_client_weights/client0_r${ROUND}/weights/best.pt"
-  "fed_client_weights/client1_r${ROUND}/weights/best.pt"
-  "fed_client_weights/client2_r${ROUND}/weights/best.pt"
-  "fed_client_weights/client3_r${ROUND}/weights/best.pt"
-)
+CLIENTS=${CLIENTS:-"0 1 2 3"}
+INPUT_MODELS=()
+DATA_YAMLS=()
+for c in ${CLIENTS}; do
+  INPUT_MODELS+=("fed_client_weights/client${c}_r${ROUND}/weights/best.pt")
+  DATA_YAMLS+=("data/kitti_client${c}.yaml")
+done
 
 echo "[Aggregator] Round ${ROUND} → aggregating:"
 for m in "${INPUT_MODELS[@]}"; do
@@ -32,18 +38,20 @@ for m in "${INPUT_MODELS[@]}"; do
 done
 echo "[Aggregator] Output: global_round_weights/global_round_${NEXT}.pt"
 
-# 執行 FedAvg 聚合
+# server optimizer 需要上一輪 global 權重（round 0 從頭訓練，沒有 global）
+GLOBAL_ARG=""
+if [ "$ROUND" -gt 0 ]; then
+  GLOBAL_ARG="-g global_round_weights/global_round_${ROUND}.pt"
+fi
+
+# 執行聚合
 TRAIN_CMD="python fed_aggregate.py \
-  -i fed_client_weights/client0_r${ROUND}/weights/best.pt \
-     fed_client_weights/client1_r${ROUND}/weights/best.pt \
-     fed_client_weights/client2_r${ROUND}/weights/best.pt \
-     fed_client_weights/client3_r${ROUND}/weights/best.pt \
+  -m ${METHOD} --bn ${BN} ${GLOBAL_ARG} --round ${ROUND} \
+  -i ${INPUT_MODELS[*]} \
+  --client-ids ${CLIENTS} \
   -o global_round_weights/global_round_${NEXT_ROUND}.pt \
   --cfg models/detect/yolov9-c.yaml \
-  -d data/kitti_client0.yaml \
-     data/kitti_client1.yaml \
-     data/kitti_client2.yaml \
-     data/kitti_client3.yaml"
+  -d ${DATA_YAMLS[*]}"
 
 echo "Executing Training Command:"
 echo "$TRAIN_CMD"
@@ -51,6 +51,9 @@ cd /home/your_account/yolov9
 #權重參數設定
 if [ "$ROUND" -eq 0 ]; then
   WEIGHTS_ARG="--weights ''"
+elif [ -f "global_round_weights/global_round_${ROUND}_client${CLIENT}.pt" ]; then
+  # FedBN (fed_aggregate.py --bn local)：沿用此 client 自己的 BN 參數
+  WEIGHTS_ARG="--weights global_round_weights/global_round_${ROUND}_client${CLIENT}.pt"
 else
   WEIGHTS_ARG="--weights global_round_weights/global_round_${ROUND}.pt"
 fi
@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from utils.tal.anchor_generator import make_anchors
+from utils.tal.assigner import TaskAlignedAssigner
+
+
+def random_case(bs=4, n=12, nc=8, s=320, seed=0):
+    # Random predictions around the anchors, overlapping gts and padded (mask_gt == 0) gts
+    g = torch.Generator().manual_seed(seed)
+    feats = [torch.zeros(bs, 1, s // k, s // k) for k in (8, 16, 32)]
+    anc, stride = make_anchors(feats, torch.tensor([8., 16., 32.]), 0.5)
+    anc = anc * stride
+    na = anc.shape[0]
+    pd_scores = torch.rand(bs, na, nc, generator=g)
+    c = anc + torch.randn(bs, na, 2, generator=g) * 4
+    wh = torch.rand(bs, na, 2, generator=g) * 80 + 4
+    pd_bboxes = torch.cat((c - wh / 2, c + wh / 2), -1)
+    gc, gwh = torch.rand(bs, n, 2, generator=g) * s, torch.rand(bs, n, 2, generator=g) * 120 + 2
+    gt_bboxes = torch.cat((gc - gwh / 2, gc + gwh / 2), -1)
+    gt_bboxes[:, :3] = gt_bboxes[:, 3:6] + torch.randn(bs, 3, 4, generator=g) * 5
+    gt_labels = torch.randint(0, nc, (bs, n, 1), generator=g).float()
+    mask_gt = torch.ones(bs, n, 1)
+    mask_gt[0, n // 2:] = 0
+    mask_gt[1, 2:] = 0
+    gt_bboxes[mask_gt.squeeze(-1) == 0] = 0
+    return pd_scores, pd_bboxes, anc, gt_labels, gt_bboxes, mask_gt
+
+
+@pytest.mark.parametrize('seed', range(16))
+@pytest.mark.parametrize('heads', [1, 2])
+@pytest.mark.parametrize('ties', [False, True])
+def test_sparse_matches_dense(seed, heads, ties):
+    pd_scores, pd_bboxes, anc, gt_labels, gt_bboxes, mask_gt = random_case(n=(6, 12, 40)[seed % 3], seed=seed)
+    if ties:  # neighbouring anchors with the same prediction tie on the metric
+        pd_scores[:, 1::2], pd_bboxes[:, 1::2] = pd_scores[:, ::2], pd_bboxes[:, ::2]
+    if heads > 1:  # stacked heads share the gts (ComputeLoss of the dual/triple models)
+        pd_scores = torch.cat((pd_scores, pd_scores.flip(1)))
+        pd_bboxes = torch.cat((pd_bboxes, pd_bboxes + 3))
+    args = pd_scores, pd_bboxes, anc, gt_labels, gt_bboxes, mask_gt
+    dense = TaskAlignedAssigner(10, 8, 0.5, 6.0)(*args)
+    sparse = TaskAlignedAssigner(10, 8, 0.5, 6.0, sparse=True, chunk=5)(*args)
+    for name, d, s in zip(('target_labels', 'target_bboxes', 'target_scores', 'fg_mask'), dense, sparse):
+        assert torch.equal(d, s), name
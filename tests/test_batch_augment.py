@@ -0,0 +1,22 @@
+import torch
+
+from utils.augmentations import BatchAugment
+
+HYP = dict(mosaic=1.0, mixup=1.0, degrees=0.0, translate=0.0, scale=0.0, shear=0.0, perspective=0.0,
+           hsv_h=0.0, hsv_s=0.0, hsv_v=0.0, flipud=0.0, fliplr=0.0)
+
+
+def fake_mosaic(imgs, labels, shapes, idx):
+    # One 40x40 box of class i in the center of mosaic i
+    _, c, h, w = imgs.shape
+    lb = torch.tensor([[i, i, w - 20, h - 20, w + 20, h + 20] for i in range(len(idx))], dtype=torch.float32)
+    return imgs.new_full((len(idx), c, 2 * h, 2 * w), 114), lb
+
+
+def test_mixup_shared_partner(monkeypatch):
+    # Both images are mixed with mosaic 0, each must get its own copy of mosaic 0's labels
+    monkeypatch.setattr(BatchAugment, '_mosaic', staticmethod(fake_mosaic))
+    monkeypatch.setattr(torch, 'randint', lambda low, high, size: torch.zeros(size, dtype=torch.long))
+    imgs = torch.full((2, 3, 64, 64), 114, dtype=torch.uint8)
+    _, labels = BatchAugment(HYP)(imgs, torch.zeros(0, 6), shapes=None)
+    assert sorted(map(tuple, labels[:, :2].tolist())) == [(0, 0), (0, 0), (1, 0), (1, 1)]
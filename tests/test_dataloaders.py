@@ -0,0 +1,41 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+from utils import dataloaders
+from utils.dataloaders import cached_dataloader, release_dataloaders
+
+
+@pytest.fixture
+def loaders(monkeypatch):
+    # create_dataloader() stand-in, records the loaders closed by the cache
+    closed = []
+    monkeypatch.setattr(dataloaders, '_LOADER_CACHE', OrderedDict())
+    monkeypatch.setattr(dataloaders, 'create_dataloader',
+                        lambda path, *args, **kwargs: (object(), SimpleNamespace(augment=True, rect=False)))
+    monkeypatch.setattr(dataloaders, 'close_dataloader', lambda loader, dataset: closed.append(loader))
+    return closed
+
+
+def train_round(clients):
+    # fed_orchestrator.py train_inprocess(): train and val loader of every selected client
+    release_dataloaders(clients)
+    keep = 2 * len(clients)
+    return {c: (cached_dataloader(f'{c}/train', owner=c, keep=keep, prefix='train: ')[0],
+                cached_dataloader('val', owner=c, keep=keep, prefix='val: ')[0]) for c in clients}
+
+
+def test_alternating_clients_reuse_loaders(loaders):
+    first = train_round(['a.yaml', 'b.yaml'])
+    assert train_round(['a.yaml', 'b.yaml']) == first
+    assert first['a.yaml'][0] is not first['b.yaml'][0]
+    assert first['a.yaml'][1] is first['b.yaml'][1]  # shared val set
+    assert not loaders
+
+
+def test_release_unselected_clients(loaders):
+    first = train_round(['a.yaml', 'b.yaml'])
+    second = train_round(['b.yaml', 'c.yaml'])
+    assert loaders == [first['a.yaml'][0]]
+    assert second['b.yaml'] == first['b.yaml']
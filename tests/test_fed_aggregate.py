@@ -0,0 +1,17 @@
+import os
+
+import torch
+
+from fed_aggregate import load_state_dict
+from fed_update import encode_update
+
+
+def test_rewritten_base_is_reloaded(tmp_path):
+    # Delta updates against global_round_{R}.pt, rewritten at the same path (same size, new mtime) between two loads
+    base, update = tmp_path / 'global_round_1.pt', tmp_path / 'client0.pt'
+    for i, value in enumerate((1.0, 2.0)):
+        base_sd = {'w': torch.full((4,), value)}
+        torch.save(base_sd, base)
+        os.utime(base, ns=(i, i))
+        torch.save(encode_update({'w': base_sd['w'] + 1}, base_sd)[0], update)
+        assert torch.equal(load_state_dict(str(update), base=str(base))['w'], torch.full((4,), value + 1))
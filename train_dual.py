@@ -6,6 +6,7 @@ import sys
 import time
 from copy import deepcopy
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 import numpy as np
@@ -28,7 +29,7 @@ from models.yolo import Model
 from utils.autoanchor import check_anchors
 from utils.autobatch import check_train_batch_size
 from utils.callbacks import Callbacks
-from utils.dataloaders import create_dataloader
+from utils.dataloaders import PrefetchLoader, cached_dataloader, create_dataloader
 from utils.downloads import attempt_download, is_url
 from utils.general import (LOGGER, TQDM_BAR_FORMAT, check_amp, check_dataset, check_file, check_git_info,
                            check_git_status, check_img_size, check_requirements, check_suffix, check_yaml, colorstr,
@@ -42,8 +43,8 @@ from utils.loss_tal_dual import ComputeLoss
 #from utils.loss_tal_dual import ComputeLossLHCF as ComputeLoss
 from utils.metrics import fitness
 from utils.plots import plot_evolve
-from utils.torch_utils import (EarlyStopping, ModelEMA, de_parallel, select_device, smart_DDP, smart_optimizer,
-                               smart_resume, torch_distributed_zero_first)
+from utils.torch_utils import (AsyncCheckpoint, EarlyStopping, ModelEMA, de_parallel, get_rng_state, select_device,
+                               set_rng_state, smart_DDP, smart_optimizer, smart_resume, torch_distributed_zero_first)
 
 LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
 RANK = int(os.getenv('RANK', -1))
@@ -165,13 +166,15 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     # from utils.plots import plot_lr_scheduler; plot_lr_scheduler(optimizer, scheduler, epochs)
 
     # EMA
-    ema = ModelEMA(model) if RANK in {-1, 0} else None
+    ema = ModelEMA(model, every=opt.ema_every) if RANK in {-1, 0} else None
 
     # Resume
-    best_fitness, start_epoch = 0.0, 0
+    best_fitness, start_epoch, mid_epoch = 0.0, 0, None
     if pretrained:
         if resume:
             best_fitness, start_epoch, epochs = smart_resume(ckpt, optimizer, ema, weights, epochs, resume)
+            if ckpt.get('step'):  # mid-epoch checkpoint from --save-steps
+                mid_epoch = {k: ckpt[k] for k in ('step', 'sampler', 'scaler', 'mloss', 'last_opt_step', 'rng')}
         del ckpt, csd
 
     # DP mode
@@ -185,41 +188,50 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         LOGGER.info('Using SyncBatchNorm()')
 
     # Trainloader
-    train_loader, dataset = create_dataloader(train_path,
-                                              imgsz,
-                                              batch_size // WORLD_SIZE,
-                                              gs,
-                                              single_cls,
-                                              hyp=hyp,
-                                              augment=True,
-                                              cache=None if opt.cache == 'val' else opt.cache,
-                                              rect=opt.rect,
-                                              rank=LOCAL_RANK,
-                                              workers=workers,
-                                              image_weights=opt.image_weights,
-                                              close_mosaic=opt.close_mosaic != 0,
-                                              quad=opt.quad,
-                                              prefix=colorstr('train: '),
-                                              shuffle=True,
-                                              min_items=opt.min_items)
+    keep = getattr(opt, 'keep_loaders', 0)
+    loader_fn = partial(cached_dataloader, owner=opt.data, keep=keep) if keep else create_dataloader
+    train_loader, dataset = loader_fn(train_path,
+                                      imgsz,
+                                      batch_size // WORLD_SIZE,
+                                      gs,
+                                      single_cls,
+                                      hyp=hyp,
+                                      augment=True,
+                                      cache=None if opt.cache == 'val' else opt.cache,
+                                      rect=opt.rect,
+                                      rank=LOCAL_RANK,
+                                      workers=workers,
+                                      image_weights=opt.image_weights,
+                                      close_mosaic=opt.close_mosaic != 0,
+                                      quad=opt.quad,
+                                      prefix=colorstr('train: '),
+                                      shuffle=True,
+                                      min_items=opt.min_items,
+                                      batch_augment=opt.batch_augment,
+                                      resumable=opt.save_steps > 0)
+    batch_augment = None
+    if opt.batch_augment == 'device' and dataset.batch_augment:  # mosaic/affine/HSV/flips on the device batch
+        def batch_augment(im, targets, shapes):
+            return dataset.batch_augment(im, targets, shapes, mosaic=dataset.mosaic)
+    train_batches = PrefetchLoader(train_loader, device, transform=batch_augment) if opt.prefetch else train_loader
     labels = np.concatenate(dataset.labels, 0)
     mlc = int(labels[:, 0].max())  # max label class
     assert mlc < nc, f'Label class {mlc} exceeds nc={nc} in {data}. Possible class labels are 0-{nc - 1}'
 
     # Process 0
     if RANK in {-1, 0}:
-        val_loader = create_dataloader(val_path,
-                                       imgsz,
-                                       batch_size // WORLD_SIZE * 2,
-                                       gs,
-                                       single_cls,
-                                       hyp=hyp,
-                                       cache=None if noval else opt.cache,
-                                       rect=True,
-                                       rank=-1,
-                                       workers=workers * 2,
-                                       pad=0.5,
-                                       prefix=colorstr('val: '))[0]
+        val_loader = loader_fn(val_path,
+                               imgsz,
+                               batch_size // WORLD_SIZE * 2,
+                               gs,
+                               single_cls,
+                               hyp=hyp,
+                               cache=None if noval else opt.cache,
+                               rect=True,
+                               rank=-1,
+                               workers=workers * 2,
+                               pad=0.5,
+                               prefix=colorstr('val: '))[0]
 
         if not resume:
             # if not opt.noautoanchor:
@@ -254,6 +266,12 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     scheduler.last_epoch = start_epoch - 1  # do not move
     scaler = torch.cuda.amp.GradScaler(enabled=amp)
     stopper, stop = EarlyStopping(patience=opt.patience), False
+    saver, last_save_step = AsyncCheckpoint(), start_epoch * nb  # mid-epoch checkpoints (--save-steps)
+    if mid_epoch:
+        scaler.load_state_dict(mid_epoch['scaler'])
+        train_loader.sampler.load_state_dict(mid_epoch['sampler'])
+        last_opt_step = last_save_step = mid_epoch['last_opt_step']
+        set_rng_state(mid_epoch['rng'])
     compute_loss = ComputeLoss(model)  # init loss class
     callbacks.run('on_train_start')
     LOGGER.info(f'Image sizes {imgsz} train, {imgsz} val\n'
@@ -269,7 +287,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
             cw = model.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
             iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
             dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
-        if epoch == (epochs - opt.close_mosaic):
+        if opt.close_mosaic and epoch >= epochs - opt.close_mosaic and dataset.mosaic:  # also when resuming later
             LOGGER.info("Closing dataloader mosaic")
             dataset.mosaic = False
 
@@ -278,17 +296,23 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
 
         mloss = torch.zeros(3, device=device)  # mean losses
-        if RANK != -1:
+        step = 0  # first batch of this epoch
+        if mid_epoch and epoch == start_epoch:
+            step, mloss = mid_epoch['step'], mid_epoch['mloss'].to(device)
+        if RANK != -1 or opt.save_steps:
             train_loader.sampler.set_epoch(epoch)
-        pbar = enumerate(train_loader)
+        pbar = enumerate(train_batches, step)
         LOGGER.info(('\n' + '%11s' * 7) % ('Epoch', 'GPU_mem', 'box_loss', 'cls_loss', 'dfl_loss', 'Instances', 'Size'))
         if RANK in {-1, 0}:
-            pbar = tqdm(pbar, total=nb, bar_format=TQDM_BAR_FORMAT)  # progress bar
+            pbar = tqdm(pbar, total=nb, initial=step, bar_format=TQDM_BAR_FORMAT)  # progress bar
         optimizer.zero_grad()
-        for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
+        for i, (imgs, targets, paths, shapes) in pbar:  # batch --------------------------------------------------------
             callbacks.run('on_train_batch_start')
             ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device, non_blocking=True).float() / 255  # uint8 to float32, 0-255 to 0.0-1.0
+            if not opt.prefetch:  # else already on device and normalised by PrefetchLoader
+                if batch_augment:
+                    imgs, targets = batch_augment(imgs.to(device, non_blocking=True), targets, shapes)
+                imgs = imgs.to(device, non_blocking=True).float() / 255  # uint8 to float32, 0-255 to 0.0-1.0
 
             # Warmup
             if ni <= nw:
@@ -340,7 +364,31 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                                      (f'{epoch}/{epochs - 1}', mem, *mloss, targets.shape[0], imgs.shape[-1]))
                 callbacks.run('on_train_batch_end', model, ni, imgs, targets, paths, list(mloss))
                 if callbacks.stop_training:
+                    saver.wait()
                     return
+
+                # Mid-epoch checkpoint, after an optimizer step so no accumulated gradients are lost
+                if opt.save_steps and ni - last_save_step >= opt.save_steps and last_opt_step == ni and i + 1 < nb:
+                    saver.save(
+                        {
+                            'epoch': epoch,
+                            'step': i + 1,  # batches of this epoch done
+                            'best_fitness': best_fitness,
+                            'model': saver.snapshot(de_parallel(model), 'model32'),  # FP32, resume is bit-exact
+                            'ema': saver.snapshot(ema.ema, 'ema32'),
+                            'updates': ema.updates,
+                            'ema_pending': ema.pending,  # compounded decay of --ema-every updates not yet applied
+                            'optimizer': saver.snapshot(optimizer.state_dict(), 'optimizer'),
+                            'scaler': scaler.state_dict(),
+                            'sampler': train_loader.sampler.state_dict((i + 1) * (batch_size // WORLD_SIZE)),
+                            'mloss': mloss.cpu(),
+                            'last_opt_step': last_opt_step,
+                            'rng': get_rng_state(),
+                            'opt': vars(opt),
+                            'git': GIT_INFO,  # {remote, branch, commit} if a git repo
+                            'date': datetime.now().isoformat()},
+                        last)
+                    last_save_step = ni
             # end batch ------------------------------------------------------------------------------------------------
 
         # Scheduler
@@ -360,6 +408,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                                                 model=ema.ema,
                                                 single_cls=single_cls,
                                                 dataloader=val_loader,
+                                                prefetch=opt.prefetch,
                                                 save_dir=save_dir,
                                                 plots=False,
                                                 callbacks=callbacks,
@@ -378,21 +427,22 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                 ckpt = {
                     'epoch': epoch,
                     'best_fitness': best_fitness,
-                    'model': deepcopy(de_parallel(model)).half(),
-                    'ema': deepcopy(ema.ema).half(),
+                    'model': saver.snapshot(de_parallel(model), 'model', half=True),  # pinned CPU copies
+                    'ema': saver.snapshot(ema.ema, 'ema', half=True),
                     'updates': ema.updates,
-                    'optimizer': optimizer.state_dict(),
+                    'optimizer': saver.snapshot(optimizer.state_dict(), 'optimizer'),
                     'opt': vars(opt),
                     'git': GIT_INFO,  # {remote, branch, commit} if a git repo
                     'date': datetime.now().isoformat()}
 
-                # Save last, best and delete
-                torch.save(ckpt, last)
-                if best_fitness == fi:
-                    torch.save(ckpt, best)
+                # Save last in the background, hard-link best and epoch copies to it
+                links = [best] if best_fitness == fi else []
                 if opt.save_period > 0 and epoch % opt.save_period == 0:
-                    torch.save(ckpt, w / f'epoch{epoch}.pt')
+                    links.append(w / f'epoch{epoch}.pt')
+                saver.save(ckpt, last, links)
                 del ckpt
+                if opt.save_period > 0:
+                    saver.wait()  # loggers may upload last.pt
                 callbacks.run('on_model_save', last, epoch, final_epoch, best_fitness, fi)
 
         # EarlyStopping
@@ -407,6 +457,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         # end epoch ----------------------------------------------------------------------------------------------------
     # end training -----------------------------------------------------------------------------------------------------
     if RANK in {-1, 0}:
+        saver.wait()
         LOGGER.info(f'\n{epoch - start_epoch + 1} epochs completed in {(time.time() - t0) / 3600:.3f} hours.')
         for f in last, best:
             if f.exists():
@@ -420,6 +471,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                         model=attempt_load(f, device).half(),
                         single_cls=single_cls,
                         dataloader=val_loader,
+                        prefetch=opt.prefetch,
                         save_dir=save_dir,
                         save_json=is_coco,
                         verbose=True,
@@ -435,7 +487,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     return results
 
 
-def parse_opt(known=False):
+def parse_opt(known=False, args=None):
     parser = argparse.ArgumentParser()
     # parser.add_argument('--weights', type=str, default=ROOT / 'yolo.pt', help='initial weights path')
     # parser.add_argument('--cfg', type=str, default='', help='model.yaml path')
@@ -477,6 +529,13 @@ def parse_opt(known=False):
     parser.add_argument('--local_rank', type=int, default=-1, help='Automatic DDP Multi-GPU argument, do not modify')
     parser.add_argument('--min-items', type=int, default=0, help='Experimental')
     parser.add_argument('--close-mosaic', type=int, default=0, help='Experimental')
+    parser.add_argument('--keep-loaders', type=int, default=0,
+                        help='reuse up to x dataloaders across in-process train() calls (0: off)')
+    parser.add_argument('--batch-augment', nargs='?', const='device', default=None, choices=['cpu', 'device'],
+                        help='batched mosaic/affine/HSV/flip augmentation after collate, in workers or on device')
+    parser.add_argument('--prefetch', action='store_true', help='copy and normalise the next batch on a side stream')
+    parser.add_argument('--save-steps', type=int, default=0, help='save a resumable mid-epoch last.pt every x steps')
+    parser.add_argument('--ema-every', type=int, default=1, help='apply the EMA every x optimizer steps')
 
     # Logger arguments
     parser.add_argument('--entity', default=None, help='Entity')
@@ -484,7 +543,7 @@ def parse_opt(known=False):
     parser.add_argument('--bbox_interval', type=int, default=-1, help='Set bounding-box image logging interval')
     parser.add_argument('--artifact_alias', type=str, default='latest', help='Version of dataset artifact to use')
 
-    return parser.parse_known_args()[0] if known else parser.parse_args()
+    return parser.parse_known_args(args)[0] if known else parser.parse_args(args)
 
 
 def main(opt, callbacks=Callbacks()):
@@ -504,7 +563,7 @@ def main(opt, callbacks=Callbacks()):
                 d = yaml.safe_load(f)
         else:
             d = torch.load(last, map_location='cpu')['opt']
-        opt = argparse.Namespace(**d)  # replace
+        opt = argparse.Namespace(**{**vars(parse_opt(True, [])), **d})  # replace, defaults for options added since
         opt.cfg, opt.weights, opt.resume = '', str(last), True  # reinstate
         if is_url(opt_data):
             opt.data = check_file(opt_data)  # avoid HUB resume auth timeout
@@ -4,10 +4,12 @@ import random
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as T
 import torchvision.transforms.functional as TF
 
-from utils.general import LOGGER, check_version, colorstr, resample_segments, segment2box, xywhn2xyxy
+from utils.general import (LOGGER, check_version, colorstr, resample_segments, segments2boxes_clip, xywh2xyxy,
+                           xywhn2xyxy, xyxy2xywhn)
 from utils.metrics import bbox_ioa
 
 IMAGENET_MEAN = 0.485, 0.456, 0.406  # RGB mean
@@ -199,15 +201,7 @@ def random_perspective(im,
         use_segments = any(x.any() for x in segments)
         new = np.zeros((n, 4))
         if use_segments:  # warp segments
-            segments = resample_segments(segments)  # upsample
-            for i, segment in enumerate(segments):
-                xy = np.ones((len(segment), 3))
-                xy[:, :2] = segment
-                xy = xy @ M.T  # transform
-                xy = xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2]  # perspective rescale or affine
-
-                # clip
-                new[i] = segment2box(xy, width, height)
+            new = segments2boxes_clip(warp_segments(segments, M, perspective), width, height)
 
         else:  # warp boxes
             xy = np.ones((n * 4, 3))
@@ -232,6 +226,18 @@ def random_perspective(im,
     return im, targets
 
 
+def warp_segments(segments, M, perspective=False):
+    # Resample all segments and transform their points with one matrix multiply, returns (k,n,2) pixel xy
+    if not perspective:  # affine commutes with linear resampling, transform the (fewer) original points first
+        if not len(segments):
+            return resample_segments(segments)
+        xy = np.concatenate(segments, 0) @ M[:2, :2].T + M[:2, 2]
+        return resample_segments(np.split(xy, np.cumsum([len(x) for x in segments])[:-1]))
+    xy = resample_segments(segments)  # upsample
+    xy = xy @ M[:, :2].T + M[:, 2]  # transform
+    return xy[..., :2] / xy[..., 2:3]  # perspective rescale
+
+
 def copy_paste(im, labels, segments, p=0.5):
     # Implement Copy-Paste augmentation https://arxiv.org/abs/2012.07177, labels as nx5 np.array(cls, xyxy)
     n = len(segments)
@@ -300,6 +306,178 @@ def box_candidates(box1, box2, wh_thr=2, ar_thr=100, area_thr=0.1, eps=1e-16):
     return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)  # candidates
 
 
+class BatchAugment:
+    # Batched mosaic, random_perspective, mixup, HSV and flip augmentation on collated uint8 RGB batches, as tensor
+    # ops on the batch device (dataloader workers for CPU batches, or the training GPU)
+    # imgs(b,3,h,w) uint8 letterboxed by LoadImagesAndLabels(batch_augment=...), targets(n,6) [image, class, xywhn]
+    def __init__(self, hyp):
+        self.hyp = hyp
+
+    def __call__(self, imgs, targets, shapes, mosaic=True):
+        hyp, device = self.hyp, imgs.device
+        b, _, h, w = imgs.shape
+        targets = targets.to(device)
+        labels = torch.cat((targets[:, :2], xywh2xyxy(targets[:, 2:6]) * targets.new_tensor([w, h, w, h])), 1)
+        is_mosaic = torch.rand(b) < hyp['mosaic'] if mosaic else torch.zeros(b, dtype=torch.bool)
+
+        out, out_labels = torch.empty_like(imgs, dtype=torch.float16 if imgs.is_cuda else torch.float32), []
+        for m in (True, False):
+            idx = (is_mosaic == m).nonzero()[:, 0]
+            if not len(idx):
+                continue
+            if m:  # 4-mosaic of the sample and 3 random batch images, as in load_mosaic()
+                ims, lb = self._mosaic(imgs, labels, shapes, idx)
+            else:
+                pos = torch.full((b,), -1, device=device)
+                pos[idx.to(device)] = torch.arange(len(idx), device=device)
+                lb = labels[pos[labels[:, 0].long()] >= 0]
+                ims, lb[:, 0] = imgs[idx.to(device)], pos[lb[:, 0].long()].to(lb.dtype)
+            ims, lb = self._perspective(ims, lb, border=(-h // 2, -w // 2) if m else (0, 0), dtype=out.dtype)
+            if m:  # mixup with another mosaic of the batch
+                j = (torch.rand(len(idx)) < hyp['mixup']).nonzero()[:, 0]
+                if len(j):
+                    k = torch.randint(0, len(idx), (len(j),))
+                    r = torch.distributions.Beta(32.0, 32.0).sample((len(j),)).view(-1, 1, 1, 1)  # mixup ratio
+                    ims[j.to(device)] = ims[j.to(device)] * r.to(device, ims.dtype) + \
+                        ims[k.to(device)] * (1 - r).to(device, ims.dtype)
+                    t, i = (lb[:, 0].long()[None] == k.to(device)[:, None]).nonzero().T  # (pair, partner label)
+                    lb2 = lb[i]  # every pair gets its partner's labels, also when partners repeat
+                    lb2[:, 0] = j.to(device)[t].to(lb.dtype)
+                    lb = torch.cat((lb, lb2), 0)
+            out[idx.to(device)] = ims
+            lb[:, 0] = idx.to(device)[lb[:, 0].long()].to(lb.dtype)
+            out_labels.append(lb)
+        labels = torch.cat(out_labels, 0)
+
+        # HSV color-space
+        if hyp['hsv_h'] or hyp['hsv_s'] or hyp['hsv_v']:
+            out = self._hsv(out)
+
+        # Flip up-down, left-right
+        for p, dim, k in ((hyp['flipud'], 2, (3, 5)), (hyp['fliplr'], 3, (2, 4))):
+            f = (torch.rand(b) < p).to(device)
+            if f.any():
+                out[f] = out[f].flip(dim)
+                i = f[labels[:, 0].long()]
+                labels[i, k[0]], labels[i, k[1]] = out.shape[dim] - labels[i, k[1]], out.shape[dim] - labels[i, k[0]]
+
+        labels = labels[labels[:, 0].argsort(stable=True)]
+        labels[:, 2:6] = xyxy2xywhn(labels[:, 2:6], w=w, h=h, clip=True, eps=1E-3)
+        return out.round_().clamp_(0, 255).byte(), labels.float()
+
+    @staticmethod
+    def _mosaic(imgs, labels, shapes, idx):
+        # Returns (n,3,2h,2w) mosaics and their pixel xyxy labels, tiles cropped to their letterbox content
+        _, c, h, w = imgs.shape
+        ims = imgs.new_full((len(idx), c, 2 * h, 2 * w), 114)
+        lbs = []
+        for j, index in enumerate(idx.tolist()):
+            yc, xc = int(random.uniform(h // 2, 2 * h - h // 2)), int(random.uniform(w // 2, 2 * w - w // 2))
+            indices = [index] + random.choices(range(len(imgs)), k=3)
+            random.shuffle(indices)
+            for i, k in enumerate(indices):
+                pw, ph = shapes[k][1][1]
+                left, top = int(round(pw - 0.1)), int(round(ph - 0.1))
+                tw, th = w - left - int(round(pw + 0.1)), h - top - int(round(ph + 0.1))  # tile content size
+                if i == 0:  # top left
+                    x1a, y1a, x2a, y2a = max(xc - tw, 0), max(yc - th, 0), xc, yc
+                    x1b, y1b, x2b, y2b = tw - (x2a - x1a), th - (y2a - y1a), tw, th
+                elif i == 1:  # top right
+                    x1a, y1a, x2a, y2a = xc, max(yc - th, 0), min(xc + tw, w * 2), yc
+                    x1b, y1b, x2b, y2b = 0, th - (y2a - y1a), min(tw, x2a - x1a), th
+                elif i == 2:  # bottom left
+                    x1a, y1a, x2a, y2a = max(xc - tw, 0), yc, xc, min(h * 2, yc + th)
+                    x1b, y1b, x2b, y2b = tw - (x2a - x1a), 0, tw, min(y2a - y1a, th)
+                else:  # bottom right
+                    x1a, y1a, x2a, y2a = xc, yc, min(xc + tw, w * 2), min(h * 2, yc + th)
+                    x1b, y1b, x2b, y2b = 0, 0, min(tw, x2a - x1a), min(y2a - y1a, th)
+                ims[j, :, y1a:y2a, x1a:x2a] = imgs[k, :, top + y1b:top + y2b, left + x1b:left + x2b]
+
+                lb = labels[labels[:, 0] == k].clone()
+                lb[:, 0] = j
+                lb[:, [2, 4]] += x1a - x1b - left
+                lb[:, [3, 5]] += y1a - y1b - top
+                lbs.append(lb)
+        lbs = torch.cat(lbs, 0)
+        lbs[:, [2, 4]] = lbs[:, [2, 4]].clamp(0, 2 * w)  # clip when using random_perspective()
+        lbs[:, [3, 5]] = lbs[:, [3, 5]].clamp(0, 2 * h)
+        return ims, lbs
+
+    def _perspective(self, ims, labels, border=(0, 0), dtype=torch.float32):
+        # random_perspective() for a batch, one random matrix per image, warped with a single grid_sample()
+        hyp, device = self.hyp, ims.device
+        n, _, hi, wi = ims.shape
+        height, width = hi + border[0] * 2, wi + border[1] * 2
+        r = torch.rand(n, 8, dtype=torch.float64) * 2 - 1  # U(-1, 1)
+        a = r[:, 0] * hyp['degrees'] * math.pi / 180
+        s = 1 + r[:, 1] * hyp['scale']
+
+        C, P, R, S, T = (torch.eye(3, dtype=torch.float64).repeat(n, 1, 1) for _ in range(5))
+        C[:, 0, 2], C[:, 1, 2] = -wi / 2, -hi / 2  # center
+        P[:, 2, 0], P[:, 2, 1] = r[:, 2] * hyp['perspective'], r[:, 3] * hyp['perspective']  # perspective
+        R[:, 0, 0], R[:, 0, 1], R[:, 1, 0], R[:, 1, 1] = s * a.cos(), s * a.sin(), -s * a.sin(), s * a.cos()
+        S[:, 0, 1] = torch.tan(r[:, 4] * hyp['shear'] * math.pi / 180)  # x shear (deg)
+        S[:, 1, 0] = torch.tan(r[:, 5] * hyp['shear'] * math.pi / 180)  # y shear (deg)
+        T[:, 0, 2] = (0.5 + r[:, 6] * hyp['translate']) * width  # x translation (pixels)
+        T[:, 1, 2] = (0.5 + r[:, 7] * hyp['translate']) * height  # y translation (pixels)
+        M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
+
+        # Warp: sample every output pixel at M^-1 @ (x, y, 1), 114 outside the source image
+        Mi = torch.linalg.inv(M).to(device, torch.float32)
+        x = torch.arange(width, device=device, dtype=torch.float32).view(1, 1, -1)
+        y = torch.arange(height, device=device, dtype=torch.float32).view(1, -1, 1)
+        xy = [Mi[:, i, 0].view(-1, 1, 1) * x + Mi[:, i, 1].view(-1, 1, 1) * y + Mi[:, i, 2].view(-1, 1, 1)
+              for i in range(3)]
+        if hyp['perspective']:
+            xy = xy[0] / xy[2], xy[1] / xy[2]
+        grid = torch.stack(((2 * xy[0] + 1) / wi - 1, (2 * xy[1] + 1) / hi - 1), -1)
+        ims = F.grid_sample(ims.to(dtype) - 114, grid.to(dtype), mode='bilinear', align_corners=False) + 114
+
+        # Transform label coordinates
+        if len(labels):
+            Ml = M.to(device, torch.float32)[labels[:, 0].long()]
+            xy = torch.ones((len(labels), 4, 3), device=device)
+            xy[..., :2] = labels[:, [2, 3, 4, 5, 2, 5, 4, 3]].view(-1, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+            xy = xy @ Ml.transpose(1, 2)  # transform
+            xy = xy[..., :2] / xy[..., 2:3] if hyp['perspective'] else xy[..., :2]  # perspective rescale or affine
+            new = torch.cat((xy.min(1).values, xy.max(1).values), 1)
+            new[:, [0, 2]] = new[:, [0, 2]].clamp(0, width)
+            new[:, [1, 3]] = new[:, [1, 3]].clamp(0, height)
+
+            # filter candidates, box_candidates(area_thr=0.10)
+            w1, h1 = (labels[:, 4] - labels[:, 2]), (labels[:, 5] - labels[:, 3])
+            w2, h2 = new[:, 2] - new[:, 0], new[:, 3] - new[:, 1]
+            sl = s.to(device, torch.float32)[labels[:, 0].long()] ** 2
+            ar = torch.maximum(w2 / (h2 + 1e-16), h2 / (w2 + 1e-16))
+            i = (w2 > 2) & (h2 > 2) & (w2 * h2 / (w1 * h1 * sl + 1e-16) > 0.10) & (ar < 100)
+            labels = torch.cat((labels[i, :2], new[i]), 1)
+        return ims, labels
+
+    def _hsv(self, im):
+        # augment_hsv() with per-image random gains, im(b,3,h,w) RGB 0-255
+        hyp = self.hyp
+        r = (torch.rand(len(im), 3) * 2 - 1) * torch.tensor([hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']]) + 1
+        r = r.to(im.device, torch.float32).view(-1, 3, 1, 1)
+        x = im.float() / 255
+
+        # RGB to HSV
+        val, imax = x.max(1)
+        d = val - x.min(1).values
+        sat = torch.where(val > 0, d / val.clamp(min=1e-8), torch.zeros_like(val))
+        dc = d.clamp(min=1e-8)
+        hue = torch.stack(((x[:, 1] - x[:, 2]) / dc, (x[:, 2] - x[:, 0]) / dc + 2, (x[:, 0] - x[:, 1]) / dc + 4))
+        hue = (hue.gather(0, imax[None])[0] / 6 % 1).masked_fill_(d == 0, 0)
+
+        hue = (hue * r[:, 0]) % 1
+        sat = (sat * r[:, 1]).clamp_(0, 1)
+        val = (val * r[:, 2]).clamp_(0, 1)
+
+        # HSV to RGB
+        k = (torch.tensor([5.0, 3.0, 1.0], device=im.device).view(1, 3, 1, 1) + hue[:, None] * 6) % 6
+        x = val[:, None] * (1 - sat[:, None] * torch.minimum(k, 4 - k).clamp_(0, 1))
+        return (x * 255).to(im.dtype)
+
+
 def classify_albumentations(
         augment=True,
         size=224,
@@ -1,13 +1,19 @@
+import atexit
 import contextlib
 import glob
 import hashlib
 import json
 import math
 import os
+import queue
 import random
 import shutil
+import struct
 import time
+import zipfile
+from collections import OrderedDict
 from itertools import repeat
+from multiprocessing import resource_tracker, shared_memory
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
 from threading import Thread
@@ -23,11 +29,11 @@ from PIL import ExifTags, Image, ImageOps
 from torch.utils.data import DataLoader, Dataset, dataloader, distributed
 from tqdm import tqdm
 
-from utils.augmentations import (Albumentations, augment_hsv, classify_albumentations, classify_transforms, copy_paste,
-                                 letterbox, mixup, random_perspective)
-from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, check_dataset, check_requirements,
-                           check_yaml, clean_str, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy,
-                           xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
+from utils.augmentations import (Albumentations, BatchAugment, augment_hsv, classify_albumentations, classify_transforms,
+                                 copy_paste, letterbox, mixup, random_perspective)
+from utils.general import (CONFIG_DIR, DATASETS_DIR, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, check_dataset,
+                           check_requirements, check_yaml, clean_str, cv2, is_colab, is_kaggle, segments2boxes,
+                           unzip_file, xyn2xy, xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
 from utils.torch_utils import torch_distributed_zero_first
 
 # Parameters
@@ -37,6 +43,11 @@ VID_FORMATS = 'asf', 'avi', 'gif', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg', 't
 LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
 RANK = int(os.getenv('RANK', -1))
 PIN_MEMORY = str(os.getenv('PIN_MEMORY', True)).lower() == 'true'  # global pin_memory for dataloaders
+SHARED_LABEL_CACHE = os.getenv('SHARED_LABEL_CACHE', str(CONFIG_DIR / 'labels.shared.cache'))  # '' to disable
+SHARED_RAM_CACHE = str(os.getenv('SHARED_RAM_CACHE', True)).lower() == 'true'  # one --cache ram arena per node
+DISK_CACHE_SHARD_BYTES = 4 << 30  # --cache disk shard file size
+DISK_CACHE_MIN_LIVE = 0.5  # --cache disk shards with a smaller fraction of still indexed bytes are compacted
+REPAIR_JPEG = str(os.getenv('REPAIR_JPEG', False)).lower() == 'true'  # re-save JPEGs missing their end marker
 
 # Get orientation exif tag
 for orientation in ExifTags.TAGS.keys():
@@ -52,6 +63,183 @@ def get_hash(paths):
     return h.hexdigest()  # return hash
 
 
+def file_stat(path):
+    # Returns (size, mtime_ns) of a file, (-1, -1) if it does not exist
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+def process_start_time(pid):
+    # Returns the start time of a live process (pid reuse safe on Linux), -1 if it does not exist
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return int(f.read().rsplit(')', 1)[1].split()[19])  # field 22, starttime in clock ticks
+    except OSError:  # no such process, or no /proc (liveness only)
+        try:
+            os.kill(pid, 0)
+            return 0
+        except ProcessLookupError:
+            return -1
+        except OSError:  # exists, owned by another user
+            return 0
+
+
+def get_stat_hash(paths):
+    # Returns a single hash value of a list of paths and their sizes and modification times
+    h = hashlib.md5()
+    for p in paths:
+        h.update(f'{p}{file_stat(p)}'.encode())
+    return h.hexdigest()
+
+
+def content_key(args, chunk=1 << 16):
+    # Content address of an image-label pair (image size, head and tail bytes + full label), None if unreadable
+    im_file, lb_file = args
+    h = hashlib.md5()
+    try:
+        with open(im_file, 'rb') as f:
+            size = f.seek(0, 2)
+            f.seek(0)
+            h.update(str(size).encode() + f.read(chunk))
+            f.seek(max(size - chunk, 0))
+            h.update(f.read())
+        if os.path.isfile(lb_file):
+            with open(lb_file, 'rb') as f:
+                h.update(b'label:' + f.read())
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def load_shared_label_cache(path, version):
+    # Loads the content-addressed label cache shared by all datasets (e.g. overlapping federated splits)
+    try:
+        x = np.load(path, allow_pickle=True).item()
+        assert x.pop('version') == version
+        return x
+    except Exception:
+        return {}
+
+
+def save_cache(path, x):
+    # Saves a cache dict atomically (concurrent dataset scans may write the same shared cache)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp.npy')
+    np.save(tmp, x)
+    os.replace(tmp, path)
+
+
+def save_npz(path, **arrays):
+    # Saves arrays atomically as an uncompressed *.npz that load_npz() can memory-map
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp.npz')
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def load_npz(path):
+    # Loads an uncompressed *.npz, memory-mapping every non-empty numeric member (object members are unpickled)
+    out = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as fp:
+        for zi in zf.infolist():
+            k = zi.filename[:-4]  # strip .npy
+            if zi.compress_type != zipfile.ZIP_STORED:
+                with zf.open(zi) as f:
+                    out[k] = np.lib.format.read_array(f, allow_pickle=True)
+                continue
+            fp.seek(zi.header_offset)
+            n_name, n_extra = struct.unpack('<HH', fp.read(30)[26:30])  # local file header
+            start = zi.header_offset + 30 + n_name + n_extra
+            fp.seek(start)
+            version = np.lib.format.read_magic(fp)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(fp)
+            if dtype.hasobject or not all(shape):
+                fp.seek(start)
+                out[k] = np.lib.format.read_array(fp, allow_pickle=True)
+            else:
+                out[k] = np.memmap(path, dtype=dtype, mode='r', offset=fp.tell(), shape=shape,
+                                   order='F' if fortran_order else 'C').view(np.ndarray)
+    return out
+
+
+def compact_shards(path, shards, index, min_live=DISK_CACHE_MIN_LIVE):
+    # Copies the indexed images of mostly stale --cache disk shards into new shards and deletes every shard file under
+    # path that index no longer references. index entries (shard, offset, h, w, ...) are updated in place, returns the
+    # new shard list
+    live = np.zeros(len(shards), dtype=np.int64)  # indexed bytes per shard
+    for k, o, h, w, *_ in index.values():
+        live[k] += h * w * 3
+    size = [(path / f).stat().st_size if (path / f).exists() else 0 for f in shards]
+    move = {k for k in range(len(shards)) if 0 < live[k] < min_live * size[k]}
+    if move:
+        src, fp = {k: open(path / shards[k], 'rb') for k in move}, None
+        for e in sorted((e for e in index.values() if e[0] in move), key=lambda e: e[:2]):  # sequential reads
+            n = e[2] * e[3] * 3
+            if fp is None or fp.tell() + n > DISK_CACHE_SHARD_BYTES:
+                if fp:
+                    fp.close()
+                shards.append(f'shard_{time.time_ns()}_{os.getpid()}.bin')
+                fp = open(path / shards[-1], 'wb')
+            src[e[0]].seek(e[1])
+            buf = src[e[0]].read(n)
+            e[:2] = len(shards) - 1, fp.tell()
+            fp.write(buf)
+        fp.close()
+        for f in src.values():
+            f.close()
+    used = sorted({e[0] for e in index.values()})
+    remap = {k: i for i, k in enumerate(used)}
+    for e in index.values():
+        e[0] = remap[e[0]]
+    keep = [shards[k] for k in used]
+    for f in path.glob('shard_*.bin'):
+        if f.name not in keep:
+            f.unlink()
+    return keep
+
+
+class PackedArrays:
+    # Sequence of variable-length arrays stored in one contiguous array, item i is data[starts[i]:ends[i]]
+    # Indexing with an index array returns a reordered/filtered PackedArrays sharing the same data. If data is itself
+    # a PackedArrays (e.g. image -> polygons -> points for segments) items are returned as lists of arrays
+    def __init__(self, data, offsets=None, starts=None, ends=None):
+        self.data = data
+        self.starts = offsets[:-1] if starts is None else starts
+        self.ends = offsets[1:] if ends is None else ends
+
+    @classmethod
+    def from_list(cls, arrays, shape=(), dtype=np.float32):
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        data = np.concatenate([np.asarray(a, dtype=dtype).reshape(-1, *shape) for a in arrays] or
+                              [np.zeros((0, *shape), dtype=dtype)])
+        return cls(data, offsets)
+
+    @classmethod
+    def from_nested(cls, lists, shape=(), dtype=np.float32):
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in lists], out=offsets[1:])
+        return cls(cls.from_list([a for x in lists for a in x], shape, dtype), offsets)
+
+    def lengths(self):
+        return self.ends - self.starts
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            s, e = self.starts[i], self.ends[i]
+            return [self.data[j] for j in range(s, e)] if isinstance(self.data, PackedArrays) else self.data[s:e]
+        return PackedArrays(self.data, starts=self.starts[i], ends=self.ends[i])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
 def exif_size(img):
     # Returns exif-corrected PIL size
     s = img.size  # (width, height)
@@ -112,7 +300,12 @@ def create_dataloader(path,
                       quad=False,
                       min_items=0,
                       prefix='',
-                      shuffle=False):
+                      shuffle=False,
+                      batch_augment=None,
+                      resumable=False):
+    # batch_augment: None, 'cpu' (BatchAugment in collate, dataloader workers) or 'device' (caller applies
+    # dataset.batch_augment to each batch on its device)
+    # resumable: ResumableSampler and a persistent-worker DataLoader, so training can resume inside an epoch
     if rect and shuffle:
         LOGGER.warning('WARNING ⚠️ --rect is incompatible with DataLoader shuffle, setting shuffle=False')
         shuffle = False
@@ -131,13 +324,20 @@ def create_dataloader(path,
             image_weights=image_weights,
             min_items=min_items,
             prefix=prefix)
+    if batch_augment and (not augment or quad):
+        LOGGER.warning('WARNING ⚠️ batch augmentation requires augment=True and quad=False, setting batch_augment=None')
+    elif batch_augment:
+        dataset.batch_augment = BatchAugment(hyp)
 
     batch_size = min(batch_size, len(dataset))
     nd = torch.cuda.device_count()  # number of CUDA devices
     nw = min([os.cpu_count() // max(nd, 1), batch_size if batch_size > 1 else 0, workers])  # number of workers
     sampler = None if rank == -1 else distributed.DistributedSampler(dataset, shuffle=shuffle)
+    if resumable:
+        sampler = ResumableSampler(dataset, shuffle=shuffle) if rank != -1 else \
+            ResumableSampler(dataset, num_replicas=1, rank=0, shuffle=shuffle)
     #loader = DataLoader if image_weights else InfiniteDataLoader  # only DataLoader allows for attribute updates
-    loader = DataLoader if image_weights or close_mosaic else InfiniteDataLoader
+    loader = DataLoader if image_weights or close_mosaic or resumable else InfiniteDataLoader
     generator = torch.Generator()
     generator.manual_seed(6148914691236517205 + RANK)
     return loader(dataset,
@@ -146,11 +346,55 @@ def create_dataloader(path,
                   num_workers=nw,
                   sampler=sampler,
                   pin_memory=PIN_MEMORY,
-                  collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn,
+                  collate_fn=dataset.collate_fn_augment if batch_augment == 'cpu' and dataset.batch_augment else
+                  LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn,
                   worker_init_fn=seed_worker,
+                  persistent_workers=resumable and nw > 0 and not (image_weights or close_mosaic),
                   generator=generator), dataset
 
 
+_LOADER_CACHE = OrderedDict()  # least recently used first: call arguments -> (loader, dataset, owners)
+
+
+def cached_dataloader(*args, owner=None, keep=0, **kwargs):
+    # create_dataloader() memoised per process, so repeated in-process train() calls (fed_orchestrator.py) with the
+    # same arguments (e.g. a shared val set, or one client over several rounds) keep datasets, RAM image caches and
+    # persistent InfiniteDataLoader workers warm. owner (the client's data yaml) is recorded for release_dataloaders(),
+    # and beyond keep loaders (0: no limit) the least recently used ones are closed
+    key = repr((args, sorted(kwargs.items())))
+    if key not in _LOADER_CACHE:
+        _LOADER_CACHE[key] = (*create_dataloader(*args, **kwargs), set())
+    _LOADER_CACHE.move_to_end(key)
+    loader, dataset, owners = _LOADER_CACHE[key]
+    owners.add(owner)
+    while keep and len(_LOADER_CACHE) > keep:
+        close_dataloader(*_LOADER_CACHE.popitem(last=False)[1][:2])
+    dataset.mosaic = dataset.augment and not dataset.rect  # undo close_mosaic from a previous run
+    return loader, dataset
+
+
+def release_dataloaders(owners):
+    # Close the cached loaders that none of owners (the clients selected for the next round) has used
+    for key in [k for k, v in _LOADER_CACHE.items() if not v[2] & set(owners)]:
+        close_dataloader(*_LOADER_CACHE.pop(key)[:2])
+
+
+def close_dataloader(loader, dataset):
+    # Shut down the workers of a persistent or infinite DataLoader and free its dataset's image caches
+    it = getattr(loader, 'iterator', None) or getattr(loader, '_iterator', None)
+    if hasattr(it, '_shutdown_workers'):
+        it._shutdown_workers()
+    dataset.ims = [None] * len(dataset.ims)
+    shm = getattr(dataset, 'shm', None)
+    if shm is not None:
+        dataset.shm = None
+        if dataset.shm_owner:  # attached processes keep their mapping, later runs build a new arena
+            atexit.unregister(shm.unlink)
+            shm.unlink()
+        with contextlib.suppress(BufferError):  # views still alive elsewhere, unmapped when collected
+            shm.close()
+
+
 class InfiniteDataLoader(dataloader.DataLoader):
     """ Dataloader that reuses workers
 
@@ -185,6 +429,113 @@ class _RepeatSampler:
             yield from iter(self.sampler)
 
 
+class ResumableSampler(distributed.DistributedSampler):
+    """ DistributedSampler that can resume inside an epoch
+
+    The order of each epoch depends only on (seed, epoch). After load_state_dict() the next iteration skips the samples
+    already consumed, so a mid-epoch checkpoint resumes at the exact batch. Use num_replicas=1, rank=0 without DDP.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start = 0  # samples of this epoch to skip on the next iteration
+
+    def __iter__(self):
+        indices = list(super().__iter__())[self.start:]
+        self.start = 0
+        return iter(indices)
+
+    def state_dict(self, consumed):
+        # consumed: samples of the current epoch already trained on by this rank
+        return {'epoch': self.epoch, 'start': consumed}
+
+    def load_state_dict(self, state):
+        self.epoch, self.start = state['epoch'], state['start']
+
+
+class PrefetchLoader:
+    """ Moves, optionally transforms, and normalises the next batch while the current one is being used
+
+    CUDA: host-to-device copy and uint8 to float on a side stream. CPU: a background thread feeding a bounded queue.
+    Yields (im float 0.0-1.0, targets, paths, shapes) on device, other attributes are those of the wrapped loader.
+
+    Args:
+        loader (DataLoader): from create_dataloader()
+        device (torch.device): target device
+        half (bool): fp16 images
+        transform (callable): f(im uint8, targets, shapes) -> (im, targets) applied on device before normalising
+        depth (int): CPU queue size
+    """
+
+    def __init__(self, loader, device, half=False, transform=None, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.half = half
+        self.transform = transform
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['loader'], name)
+
+    def _prepare(self, batch):
+        im, targets, paths, shapes = batch
+        im, targets = im.to(self.device, non_blocking=True), targets.to(self.device, non_blocking=True)
+        if self.transform:
+            im, targets = self.transform(im, targets, shapes)
+        im = (im.half() if self.half else im.float()) / 255  # uint8 to fp16/32, 0-255 to 0.0-1.0
+        return im, targets, paths, shapes
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            yield from self._iter_cuda()
+        else:
+            yield from self._iter_thread()
+
+    def _iter_cuda(self):
+        stream, batch = torch.cuda.Stream(self.device), None
+        for x in self.loader:
+            with torch.cuda.stream(stream):
+                x = self._prepare(x)
+            if batch is not None:
+                yield batch
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            for t in x[:2]:
+                t.record_stream(torch.cuda.current_stream(self.device))  # allocated on the side stream
+            batch = x
+        if batch is not None:
+            yield batch
+
+    def _iter_thread(self):
+        q, stop = queue.Queue(maxsize=self.depth), []
+
+        def put(x):
+            while not stop:
+                with contextlib.suppress(queue.Full):
+                    return q.put(x, timeout=0.1)
+
+        def producer():
+            try:
+                for x in self.loader:
+                    put(self._prepare(x))
+                    if stop:
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        Thread(target=producer, daemon=True).start()
+        try:
+            while (x := q.get()) is not None:
+                if isinstance(x, Exception):
+                    raise x
+                yield x
+        finally:
+            stop.append(True)  # consumer stopped early or finished, release the producer
+
+
 class LoadScreenshots:
     # YOLOv5 screenshot dataloader, i.e. `python detect.py --source "screen 0 100 100 512 256"`
     def __init__(self, source, img_size=640, stride=32, auto=True, transforms=None):
@@ -429,7 +780,7 @@ def img2label_paths(img_paths):
 
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
-    cache_version = 0.6  # dataset labels *.cache version
+    cache_version = 0.8  # dataset labels *.cache version
     rand_interp_methods = [cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, cv2.INTER_LANCZOS4]
 
     def __init__(self,
@@ -456,6 +807,7 @@ class LoadImagesAndLabels(Dataset):
         self.stride = stride
         self.path = path
         self.albumentations = Albumentations(size=img_size) if augment else None
+        self.batch_augment = None  # BatchAugment run on whole batches after collate, see create_dataloader()
 
         try:
             f = []  # image files
@@ -481,15 +833,20 @@ class LoadImagesAndLabels(Dataset):
         # Check cache
         self.label_files = img2label_paths(self.im_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
+        if REPAIR_JPEG:  # opt-in pass, repaired files get a new mtime and are re-verified below
+            repair_jpegs(self.im_files, prefix)
+        cache, exists = None, False
         try:
-            cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
+            cache = self.load_label_cache(cache_path)  # memory-mapped arrays
             assert cache['version'] == self.cache_version  # matches current version
-            assert cache['hash'] == get_hash(self.label_files + self.im_files)  # identical hash
+            exists = cache['hash'] == get_stat_hash(self.label_files + self.im_files)  # same paths, sizes and mtimes
         except Exception:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # run cache ops
+            cache = None
+        if not exists:
+            cache = self.cache_labels(cache_path, prefix, old=cache)  # verify new or changed files only
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupt, total
+        nf, nm, ne, nc, n = cache['results']  # found, missing, empty, corrupt, total
         if exists and LOCAL_RANK in {-1, 0}:
             d = f"Scanning {cache_path}... {nf} images, {nm + ne} backgrounds, {nc} corrupt"
             tqdm(None, desc=prefix + d, total=n, initial=n, bar_format=TQDM_BAR_FORMAT)  # display cache results
@@ -498,23 +855,23 @@ class LoadImagesAndLabels(Dataset):
         assert nf > 0 or not augment, f'{prefix}No labels found in {cache_path}, can not start training. {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
-        labels, shapes, self.segments = zip(*cache.values())
-        nl = len(np.concatenate(labels, 0))  # number of labels
+        valid = (cache['counts'][:, 3] == 0).nonzero()[0]  # drop corrupt images
+        self.labels = cache['labels'][valid]  # PackedArrays, contiguous float32 (cls, xywh) rows
+        self.segments = cache['segments'][valid]  # PackedArrays of per-image polygon lists
+        nl = int(self.labels.lengths().sum())  # number of labels
         assert nl > 0 or not augment, f'{prefix}All labels empty in {cache_path}, can not start training. {HELP_URL}'
-        self.labels = list(labels)
-        self.shapes = np.array(shapes)
-        self.im_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        self.shapes = np.array(cache['shapes'][valid])
+        self.im_files = cache['im_files'][valid].tolist()  # update
+        self.label_files = img2label_paths(self.im_files)  # update
 
         # Filter images
         if min_items:
-            include = np.array([len(x) >= min_items for x in self.labels]).nonzero()[0].astype(int)
+            include = (self.labels.lengths() >= min_items).nonzero()[0]
             LOGGER.info(f'{prefix}{n - len(include)}/{n} images filtered from dataset')
             self.im_files = [self.im_files[i] for i in include]
             self.label_files = [self.label_files[i] for i in include]
-            self.labels = [self.labels[i] for i in include]
-            self.segments = [self.segments[i] for i in include]
+            self.labels = self.labels[include]
+            self.segments = self.segments[include]
             self.shapes = self.shapes[include]  # wh
 
         # Create indices
@@ -528,14 +885,17 @@ class LoadImagesAndLabels(Dataset):
         # Update labels
         include_class = []  # filter labels to include only these classes (optional)
         include_class_array = np.array(include_class).reshape(1, -1)
-        for i, (label, segment) in enumerate(zip(self.labels, self.segments)):
-            if include_class:
+        if include_class:
+            labels, segments = [], []
+            for label, segment in zip(self.labels, self.segments):
                 j = (label[:, 0:1] == include_class_array).any(1)
-                self.labels[i] = label[j]
-                if segment:
-                    self.segments[i] = segment[j]
-            if single_cls:  # single-class training, merge all classes into 0
-                self.labels[i][:, 0] = 0
+                labels.append(label[j])
+                segments.append([x for x, k in zip(segment, j) if k] if segment else segment)
+            self.labels = PackedArrays.from_list(labels, (5,))
+            self.segments = PackedArrays.from_nested(segments, (2,))
+        if single_cls:  # single-class training, merge all classes into 0
+            self.labels = PackedArrays(np.array(self.labels.data), starts=self.labels.starts, ends=self.labels.ends)
+            self.labels.data[:, 0] = 0  # writable copy of the memory-mapped cache
 
         # Rectangular Training
         if self.rect:
@@ -545,8 +905,8 @@ class LoadImagesAndLabels(Dataset):
             irect = ar.argsort()
             self.im_files = [self.im_files[i] for i in irect]
             self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
-            self.segments = [self.segments[i] for i in irect]
+            self.labels = self.labels[irect]
+            self.segments = self.segments[irect]
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
@@ -563,25 +923,103 @@ class LoadImagesAndLabels(Dataset):
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
 
         # Cache images into RAM/disk for faster training
+        self.ims = [None] * n
+        self.im_hw0, self.im_hw = [None] * n, [None] * n
+        if cache_images == 'disk':
+            suffix = f"images{img_size}{'_aug' if augment else ''}"  # resize interpolation depends on augment
+            self.cache_images_packed(cache_path.with_name(f'{cache_path.stem}.{suffix}'), prefix)
+            cache_images = False
+        if cache_images == 'ram' and SHARED_RAM_CACHE and self.cache_images_shared(prefix, create=False):
+            cache_images = False  # attached to the arena built by another rank on this node
         if cache_images == 'ram' and not self.check_cache_ram(prefix=prefix):
             cache_images = False
-        self.ims = [None] * n
-        self.npy_files = [Path(f).with_suffix('.npy') for f in self.im_files]
+        if cache_images == 'ram' and SHARED_RAM_CACHE and self.cache_images_shared(prefix, create=True):
+            cache_images = False
         if cache_images:
             b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-            self.im_hw0, self.im_hw = [None] * n, [None] * n
-            fcn = self.cache_images_to_disk if cache_images == 'disk' else self.load_image
-            results = ThreadPool(NUM_THREADS).imap(fcn, range(n))
+            results = ThreadPool(NUM_THREADS).imap(self.load_image, range(n))
             pbar = tqdm(enumerate(results), total=n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
             for i, x in pbar:
-                if cache_images == 'disk':
-                    b += self.npy_files[i].stat().st_size
-                else:  # 'ram'
-                    self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    b += self.ims[i].nbytes
+                self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
+                b += self.ims[i].nbytes
                 pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB {cache_images})'
             pbar.close()
 
+    def cache_images_shared(self, prefix='', create=False):
+        # Node-level RAM cache: the first process (local rank 0) loads resized images once into a shared memory arena,
+        # the other DDP ranks attach to it read-only and DataLoader workers inherit the mapping. Arena layout:
+        # header (int64) of ready flag, owner pid and owner start time, index (n, 5) of (offset, h, w, h0, w0) with
+        # offset -1 if not cached, then image bytes. Returns True if self.ims now points into the arena
+        n = self.n
+        h = hashlib.md5(f'{os.getuid()}{self.img_size}{self.augment}'.encode())
+        h.update(get_stat_hash(self.im_files).encode())  # images edited in place get a new arena
+        name = f'yolo_{h.hexdigest()[:16]}'
+        shm = None
+        try:
+            if create:
+                wh0 = self.shapes.astype(np.int64)  # original wh from the label cache
+                r = self.img_size / wh0.max(1)
+                wh = np.where((r != 1)[:, None], (wh0 * r[:, None]).astype(np.int64), wh0)  # as load_image()
+                nbytes = wh.prod(1) * 3
+                offsets = np.zeros(n + 1, dtype=np.int64)
+                np.cumsum(nbytes, out=offsets[1:])
+                head = 24 + n * 5 * 8
+                size = int(head + offsets[-1])
+                if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free < size:
+                    LOGGER.info(f'{prefix}{size / (1 << 30):.1f}GB /dev/shm required for shared RAM cache, '
+                                f"{shutil.disk_usage('/dev/shm').free / (1 << 30):.1f}GB free, caching per process")
+                    return False
+                shm = shared_memory.SharedMemory(name, create=True, size=size)
+                atexit.register(shm.unlink)  # mappings of attached processes stay valid after unlink
+                header, index = np.ndarray(3, np.int64, shm.buf), np.ndarray((n, 5), np.int64, shm.buf, offset=24)
+                header[:] = 0, os.getpid(), process_start_time(os.getpid())
+                b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
+                results = ThreadPool(NUM_THREADS).imap(self.load_image, range(n))
+                pbar = tqdm(enumerate(results), total=n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
+                for i, (im, hw0, hw) in pbar:
+                    if im.nbytes == nbytes[i]:
+                        o = head + offsets[i]
+                        np.ndarray(im.shape, np.uint8, shm.buf, offset=o)[:] = im
+                        index[i] = o, *hw, *hw0
+                        b += im.nbytes
+                    else:  # decoded shape differs from the label cache, load this image from disk
+                        index[i] = -1, 0, 0, 0, 0
+                    pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB shared ram)'
+                pbar.close()
+                header[0] = 1
+            else:
+                shm = shared_memory.SharedMemory(name)
+                header, index = np.ndarray(3, np.int64, shm.buf), np.ndarray((n, 5), np.int64, shm.buf, offset=24)
+                flag, pid, start = header.tolist()
+                if process_start_time(pid) != start:  # owner killed (SIGKILL, OOM) before it could unlink
+                    del header, index
+                    shm.close()
+                    shm.unlink()
+                    LOGGER.info(f'{prefix}Removed shared RAM image cache {name} left by dead process {pid}')
+                    return False
+                resource_tracker.unregister(shm._name, 'shared_memory')  # owner unlinks, not attaching processes
+                if flag != 1:  # owner still building
+                    del header, index
+                    shm.close()
+                    return False
+                LOGGER.info(f'{prefix}Attached to shared RAM image cache {name}')
+        except FileNotFoundError:  # no arena to attach to
+            return False
+        except Exception as e:
+            LOGGER.warning(f'{prefix}WARNING ⚠️ Shared RAM image cache unavailable, caching per process: {e}')
+            if create and shm is not None:
+                atexit.unregister(shm.unlink)
+                shm.unlink()
+            return False
+
+        for i, (o, h, w, h0, w0) in enumerate(index.tolist()):
+            if o >= 0:
+                im = np.ndarray((h, w, 3), np.uint8, shm.buf, offset=o)
+                im.flags.writeable = False
+                self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), (h, w)
+        self.shm, self.shm_owner = shm, create  # keep the mapping alive
+        return True
+
     def check_cache_ram(self, safety_margin=0.1, prefix=''):
         # Check image caching requirements vs available memory
         b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
@@ -599,42 +1037,112 @@ class LoadImagesAndLabels(Dataset):
                         f"{'caching images ✅' if cache else 'not caching images ⚠️'}")
         return cache
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', old=None):
         # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
+        # Entries of the previous cache whose image and label (size, mtime) are unchanged are reused, the rest are
+        # looked up by content in SHARED_LABEL_CACHE and only verified if not found there
         desc = f"{prefix}Scanning {path.parent / path.stem}..."
-        with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.im_files, self.label_files, repeat(prefix))),
-                        desc=desc,
-                        total=len(self.im_files),
-                        bar_format=TQDM_BAR_FORMAT)
-            for im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
-                if im_file:
-                    x[im_file] = [lb, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc} {nf} images, {nm + ne} backgrounds, {nc} corrupt"
-
-        pbar.close()
+        stats = np.array([(*file_stat(im), *file_stat(lb)) for im, lb in zip(self.im_files, self.label_files)],
+                         dtype=np.int64).reshape(-1, 4)
+        records = [None] * len(self.im_files)  # [lb, shape, segments, nm, nf, ne, nc, msg]
+        keys = [None] * len(self.im_files)
+        if old:
+            old_index = {f: j for j, f in enumerate(old['im_files'].tolist())}
+            for i, im_file in enumerate(self.im_files):
+                j = old_index.get(im_file)
+                if j is not None and (old['stats'][j] == stats[i]).all():
+                    records[i] = [old['labels'][j], tuple(old['shapes'][j]), old['segments'][j],
+                                  *old['counts'][j].tolist(), old['file_msgs'].get(j, '')]
+                    keys[i] = old['keys'][j] or None
+        todo = [i for i, r in enumerate(records) if r is None]
+
+        shared_path = Path(SHARED_LABEL_CACHE) if SHARED_LABEL_CACHE else None
+        shared = load_shared_label_cache(shared_path, self.cache_version) if shared_path and todo else {}
+        n_shared, verify, speed = len(shared), [], 0.0
+        if todo:
+            with Pool(NUM_THREADS) as pool:
+                chunksize = max(1, min(64, len(todo) // (NUM_THREADS * 4)))  # unordered results, chunked dispatch
+                if shared_path:
+                    args = [(i, content_key, (self.im_files[i], self.label_files[i])) for i in todo]
+                    for i, k in pool.imap_unordered(call_indexed, args, chunksize=chunksize):
+                        keys[i] = k
+                        if k in shared:
+                            records[i] = list(shared[k])
+                verify = [i for i in todo if records[i] is None]
+                args = [(i, verify_image_label, (self.im_files[i], self.label_files[i], prefix)) for i in verify]
+                t = time.time()
+                pbar = tqdm(pool.imap_unordered(call_indexed, args, chunksize=chunksize),
+                            desc=desc,
+                            total=len(verify),
+                            bar_format=TQDM_BAR_FORMAT,
+                            disable=not verify)
+                for k, (i, (_, *r)) in enumerate(pbar):
+                    records[i] = r
+                    if keys[i]:
+                        shared[keys[i]] = r
+                    speed = (k + 1) / max(time.time() - t, 1e-6)
+                    pbar.desc = f'{desc} {speed:.0f} images/s'
+            pbar.close()
+
+        counts = np.array([r[3:7] for r in records], dtype=np.int8).reshape(-1, 4)  # nm, nf, ne, nc per file
+        nm, nf, ne, nc = counts.sum(0).tolist()  # number missing, found, empty, corrupt
+        file_msgs = {i: r[7] for i, r in enumerate(records) if r[7]}
+        msgs = list(file_msgs.values())  # warnings
         if msgs:
             LOGGER.info('\n'.join(msgs))
         if nf == 0:
             LOGGER.warning(f'{prefix}WARNING ⚠️ No labels found in {path}. {HELP_URL}')
-        x['hash'] = get_hash(self.label_files + self.im_files)
-        x['results'] = nf, nm, ne, nc, len(self.im_files)
-        x['msgs'] = msgs  # warnings
-        x['version'] = self.cache_version  # cache version
+        LOGGER.info(f'{prefix}{len(self.im_files) - len(todo)} unchanged, {len(todo) - len(verify)} shared, '
+                    f'{len(verify)} verified' + (f' ({speed:.0f} images/s)' if verify else ''))
+        x = {
+            'hash': get_stat_hash(self.label_files + self.im_files),
+            'results': (nf, nm, ne, nc, len(self.im_files)),
+            'speed': speed,  # verification throughput, images/s
+            'msgs': msgs,
+            'file_msgs': file_msgs,
+            'version': self.cache_version,  # cache version
+            'im_files': np.array(self.im_files, dtype=str),
+            'shapes': np.array([r[1] if r[1] is not None else (0, 0) for r in records], dtype=np.int64).reshape(-1, 2),
+            'stats': stats,
+            'keys': np.array([k or '' for k in keys], dtype=str),
+            'counts': counts,
+            'labels': PackedArrays.from_list([r[0] if r[0] is not None else () for r in records], (5,)),
+            'segments': PackedArrays.from_nested([r[2] or [] for r in records], (2,))}
         try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
+            self.save_label_cache(path, x)  # save cache for next time
             LOGGER.info(f'{prefix}New cache created: {path}')
         except Exception as e:
             LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')  # not writeable
+        if shared_path and len(shared) > n_shared:
+            try:
+                shared_path.parent.mkdir(parents=True, exist_ok=True)
+                save_cache(shared_path, {**load_shared_label_cache(shared_path, self.cache_version), **shared,
+                                         'version': self.cache_version})
+            except Exception as e:
+                LOGGER.warning(f'{prefix}WARNING ⚠️ Shared label cache {shared_path} is not writeable: {e}')
+        return x
+
+    @staticmethod
+    def save_label_cache(path, x):
+        # Labels and segments are stored as contiguous arrays + offsets so load_label_cache() can memory-map them
+        meta = {k: x[k] for k in ('hash', 'results', 'speed', 'msgs', 'file_msgs', 'version')}
+        labels, segments = x['labels'], x['segments']
+        save_npz(path,
+                 meta=np.array(meta, dtype=object),
+                 **{k: x[k] for k in ('im_files', 'shapes', 'stats', 'keys', 'counts')},
+                 labels=labels.data,
+                 label_offsets=np.append(labels.starts, labels.ends[-1:]),
+                 seg_points=segments.data.data,
+                 seg_poly_offsets=np.append(segments.data.starts, segments.data.ends[-1:]),
+                 seg_offsets=np.append(segments.starts, segments.ends[-1:]))
+
+    @staticmethod
+    def load_label_cache(path):
+        a = load_npz(path)
+        x = a.pop('meta').item()
+        x.update({k: a[k] for k in ('im_files', 'shapes', 'stats', 'keys', 'counts')})
+        x['labels'] = PackedArrays(a['labels'], a['label_offsets'])
+        x['segments'] = PackedArrays(PackedArrays(a['seg_points'], a['seg_poly_offsets']), a['seg_offsets'])
         return x
 
     def __len__(self):
@@ -650,7 +1158,7 @@ class LoadImagesAndLabels(Dataset):
         index = self.indices[index]  # linear, shuffled, or image_weights
 
         hyp = self.hyp
-        mosaic = self.mosaic and random.random() < hyp['mosaic']
+        mosaic = self.mosaic and not self.batch_augment and random.random() < hyp['mosaic']
         if mosaic:
             # Load mosaic
             img, labels = self.load_mosaic(index)
@@ -673,7 +1181,7 @@ class LoadImagesAndLabels(Dataset):
             if labels.size:  # normalized xywh to pixel xyxy format
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
 
-            if self.augment:
+            if self.augment and not self.batch_augment:
                 img, labels = random_perspective(img,
                                                  labels,
                                                  degrees=hyp['degrees'],
@@ -691,6 +1199,7 @@ class LoadImagesAndLabels(Dataset):
             img, labels = self.albumentations(img, labels)
             nl = len(labels)  # update after albumentations
 
+        if self.augment and not self.batch_augment:
             # HSV color-space
             augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
@@ -722,13 +1231,10 @@ class LoadImagesAndLabels(Dataset):
 
     def load_image(self, i):
         # Loads 1 image from dataset index 'i', returns (im, original hw, resized hw)
-        im, f, fn = self.ims[i], self.im_files[i], self.npy_files[i],
-        if im is None:  # not cached in RAM
-            if fn.exists():  # load npy
-                im = np.load(fn)
-            else:  # read image
-                im = cv2.imread(f)  # BGR
-                assert im is not None, f'Image Not Found {f}'
+        im, f = self.ims[i], self.im_files[i]
+        if im is None:  # not cached in RAM or disk shards
+            im = cv2.imread(f)  # BGR
+            assert im is not None, f'Image Not Found {f}'
             h0, w0 = im.shape[:2]  # orig hw
             r = self.img_size / max(h0, w0)  # ratio
             if r != 1:  # if sizes are not equal
@@ -737,11 +1243,54 @@ class LoadImagesAndLabels(Dataset):
             return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
         return self.ims[i], self.im_hw0[i], self.im_hw[i]  # im, hw_original, hw_resized
 
-    def cache_images_to_disk(self, i):
-        # Saves an image as an *.npy file for faster loading
-        f = self.npy_files[i]
-        if not f.exists():
-            np.save(f.as_posix(), cv2.imread(self.im_files[i]))
+    def cache_images_packed(self, path, prefix=''):
+        # Disk cache of images resized to img_size, packed into a few large shard files under 'path' and memory-mapped
+        # into self.ims. index.npz maps image path -> (shard, offset, h, w, h0, w0, size, mtime_ns); images that are
+        # new or changed since the last build are appended as a new shard, so the cache is reused across runs, and
+        # shards left mostly stale by those updates are compacted by compact_shards()
+        index = {}
+        try:
+            x = load_npz(path / 'index.npz')
+            shards = x['shards'].tolist()
+            index = dict(zip(x['im_files'].tolist(), x['entries'].tolist()))
+        except Exception:
+            shards = []
+        stats = [file_stat(f) for f in self.im_files]
+        todo = [i for i, (f, st) in enumerate(zip(self.im_files, stats))
+                if f not in index or tuple(index[f][6:]) != st]
+        if todo:
+            try:
+                path.mkdir(parents=True, exist_ok=True)
+                b, gb, fp = 0, 1 << 30, None  # bytes of cached images, bytes per gigabytes, open shard
+                results = ThreadPool(NUM_THREADS).imap(self.load_image, todo)
+                pbar = tqdm(zip(todo, results), total=len(todo), bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
+                for i, (im, hw0, hw) in pbar:
+                    if fp is None or fp.tell() + im.nbytes > DISK_CACHE_SHARD_BYTES:
+                        if fp:
+                            fp.close()
+                        shards.append(f'shard_{time.time_ns()}_{os.getpid()}.bin')
+                        fp = open(path / shards[-1], 'wb')
+                    index[self.im_files[i]] = [len(shards) - 1, fp.tell(), *hw, *hw0, *stats[i]]
+                    fp.write(np.ascontiguousarray(im).data)
+                    b += im.nbytes
+                    pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB disk shards)'
+                fp.close()
+                shards = compact_shards(path, shards, index)
+                files = list(index)
+                save_npz(path / 'index.npz',
+                         shards=np.array(shards, dtype=str),
+                         im_files=np.array(files, dtype=str),
+                         entries=np.array([index[f] for f in files], dtype=np.int64).reshape(-1, 8))
+            except Exception as e:
+                LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path} is not writeable: {e}')
+                return
+
+        mm = [np.memmap(path / f, dtype=np.uint8, mode='r') if (path / f).stat().st_size else None for f in shards]
+        for i, f in enumerate(self.im_files):
+            k, o, h, w, h0, w0 = index[f][:6]
+            self.ims[i] = mm[k][o:o + h * w * 3].view(np.ndarray).reshape(h, w, 3)
+            self.im_hw0[i], self.im_hw[i] = (h0, w0), (h, w)
+        LOGGER.info(f'{prefix}{len(self.im_files) - len(todo)}/{len(self.im_files)} images reused from {path}')
 
     def load_mosaic(self, index):
         # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
@@ -885,6 +1434,12 @@ class LoadImagesAndLabels(Dataset):
             lb[:, 0] = i  # add target image index for build_targets()
         return torch.stack(im, 0), torch.cat(label, 0), path, shapes
 
+    def collate_fn_augment(self, batch):
+        # collate_fn() followed by BatchAugment, run in the dataloader workers
+        im, label, path, shapes = self.collate_fn(batch)
+        im, label = self.batch_augment(im, label, shapes, mosaic=self.mosaic)
+        return im, label, path, shapes
+
     @staticmethod
     def collate_fn4(batch):
         im, label, path, shapes = zip(*batch)  # transposed
@@ -983,23 +1538,53 @@ def autosplit(path=DATASETS_DIR / 'coco128/images', weights=(0.9, 0.1, 0.0), ann
                 f.write(f'./{img.relative_to(path.parent).as_posix()}' + '\n')  # add image to txt file
 
 
+def call_indexed(args):
+    # (i, fn, fn_args) -> (i, fn(fn_args)), matches imap_unordered() results back to their inputs
+    i, fn, fn_args = args
+    return i, fn(fn_args)
+
+
+def is_corrupt_jpeg(im_file):
+    # JPEG missing its end-of-image marker (truncated write/download)
+    with open(im_file, 'rb') as f:
+        f.seek(-2, 2)
+        return f.read() != b'\xff\xd9'
+
+
+def repair_jpeg(args):
+    # Re-saves a corrupt JPEG in place, returns a message if it was repaired or could not be
+    im_file, prefix = args
+    try:
+        if im_file.split('.')[-1].lower() not in ('jpg', 'jpeg') or not is_corrupt_jpeg(im_file):
+            return ''
+        ImageOps.exif_transpose(Image.open(im_file)).save(im_file, 'JPEG', subsampling=0, quality=100)
+        return f'{prefix}WARNING ⚠️ {im_file}: corrupt JPEG restored and saved'
+    except Exception as e:
+        return f'{prefix}WARNING ⚠️ {im_file}: corrupt JPEG could not be restored: {e}'
+
+
+def repair_jpegs(im_files, prefix=''):
+    # Explicit JPEG repair pass (REPAIR_JPEG=true), verification itself never modifies images
+    with ThreadPool(NUM_THREADS) as pool:
+        msgs = [m for m in pool.imap_unordered(repair_jpeg, zip(im_files, repeat(prefix)), chunksize=64) if m]
+    if msgs:
+        LOGGER.info('\n'.join(msgs))
+    return msgs
+
+
 def verify_image_label(args):
-    # Verify one image-label pair
+    # Verify one image-label pair, reads only the image header (size, format, EXIF) and its last 2 bytes for JPEGs
     im_file, lb_file, prefix = args
     nm, nf, ne, nc, msg, segments = 0, 0, 0, 0, '', []  # number (missing, found, empty, corrupt), message, segments
     try:
         # verify images
-        im = Image.open(im_file)
-        im.verify()  # PIL verify
-        shape = exif_size(im)  # image size
+        with Image.open(im_file) as im:  # lazy, image data is not decoded
+            shape = exif_size(im)  # image size
+            fmt = (im.format or '').lower()
         assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-        assert im.format.lower() in IMG_FORMATS, f'invalid image format {im.format}'
-        if im.format.lower() in ('jpg', 'jpeg'):
-            with open(im_file, 'rb') as f:
-                f.seek(-2, 2)
-                if f.read() != b'\xff\xd9':  # corrupt JPEG
-                    ImageOps.exif_transpose(Image.open(im_file)).save(im_file, 'JPEG', subsampling=0, quality=100)
-                    msg = f'{prefix}WARNING ⚠️ {im_file}: corrupt JPEG restored and saved'
+        assert fmt in IMG_FORMATS, f'invalid image format {fmt}'
+        if fmt in ('jpg', 'jpeg') and is_corrupt_jpeg(im_file):
+            msg = f'{prefix}WARNING ⚠️ {im_file}: corrupt JPEG, set REPAIR_JPEG=true to restore it'
 
         # verify labels
         if os.path.isfile(lb_file):
@@ -798,6 +798,19 @@ def xyn2xy(x, w=640, h=640, padw=0, padh=0):
     return y
 
 
+def targets2batch(targets, batch_size, scale_tensor):
+    # Convert (n,6) [image, cls, xywh] targets to (batch_size, max_boxes, 5) [cls, xyxy * scale], zero padded
+    if targets.shape[0] == 0:
+        return torch.zeros(batch_size, 0, 5, device=targets.device)
+    i, order = targets[:, 0].long().sort(stable=True)  # keeps label order within each image
+    counts = torch.bincount(i, minlength=batch_size)
+    j = torch.arange(len(i), device=i.device) - (counts.cumsum(0) - counts)[i]  # position within image
+    out = torch.zeros(batch_size, int(counts.max()), 5, device=targets.device)
+    out[i, j] = targets[order, 1:].float()
+    out[..., 1:5] = xywh2xyxy(out[..., 1:5].mul_(scale_tensor))
+    return out
+
+
 def segment2box(segment, width=640, height=640):
     # Convert 1 segment label to 1 box label, applying inside-image constraint, i.e. (xy1, xy2, ...) to (xyxy)
     x, y = segment.T  # segment xy
@@ -806,6 +819,16 @@ def segment2box(segment, width=640, height=640):
     return np.array([x.min(), y.min(), x.max(), y.max()]) if any(x) else np.zeros((1, 4))  # xyxy
 
 
+def segments2boxes_clip(segments, width=640, height=640):
+    # Vectorized segment2box() for (k,n,2) segments, returns (k,4) xyxy of the points inside the image
+    x, y = segments[..., 0], segments[..., 1]
+    inside = (x >= 0) & (y >= 0) & (x <= width) & (y <= height)
+    boxes = np.stack((np.where(inside, x, np.inf).min(1), np.where(inside, y, np.inf).min(1),
+                      np.where(inside, x, -np.inf).max(1), np.where(inside, y, -np.inf).max(1)), 1)
+    boxes[~(inside & (x != 0)).any(1)] = 0  # no points inside
+    return boxes
+
+
 def segments2boxes(segments):
     # Convert segment labels to box labels, i.e. (cls, xy1, xy2, ...) to (cls, xywh)
     boxes = []
@@ -816,13 +839,16 @@ def segments2boxes(segments):
 
 
 def resample_segments(segments, n=1000):
-    # Up-sample an (n,2) segment
-    for i, s in enumerate(segments):
-        s = np.concatenate((s, s[0:1, :]), axis=0)
-        x = np.linspace(0, len(s) - 1, n)
-        xp = np.arange(len(s))
-        segments[i] = np.concatenate([np.interp(x, xp, s[:, i]) for i in range(2)]).reshape(2, -1).T  # segment xy
-    return segments
+    # Up-sample (m,2) segments to (n,2) each, all segments at once, returns (k,n,2) array
+    if not len(segments):
+        return np.zeros((0, n, 2))
+    lengths = np.array([len(s) for s in segments])
+    ends = lengths.cumsum()
+    xy = np.concatenate(segments, 0)
+    xy = np.insert(xy, ends, xy[ends - lengths], axis=0)  # close every polygon, (sum(lengths+1),2)
+    x = np.linspace(0, lengths, n, axis=1) + (ends - lengths + np.arange(len(lengths)))[:, None]  # query positions
+    xp = np.arange(len(xy))
+    return np.stack([np.interp(x, xp, xy[:, i]) for i in range(2)], -1)  # segment xy
 
 
 def scale_boxes(img1_shape, boxes, img0_shape, ratio_pad=None):
@@ -892,6 +918,7 @@ def non_max_suppression(
         labels=(),
         max_det=300,
         nm=0,  # number of masks
+        batched=False,  # one NMS call for the whole batch, no time limit
 ):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping detections
 
@@ -924,6 +951,41 @@ def non_max_suppression(
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
 
+    if batched and not labels:
+        # Detections matrix nx6 (xyxy, conf, cls) of all images at once, b = image index
+        x = prediction.transpose(1, 2)  # (bs, anchors, 4 + nc + nm)
+        box, cls, mask = x.split((4, nc, nm), 2)
+        if multi_label:
+            b, a, j = (cls > conf_thres).nonzero(as_tuple=False).T
+            conf = cls[b, a, j]
+        else:  # best class only
+            conf, j = cls.max(2)
+            b, a = (conf > conf_thres).nonzero(as_tuple=False).T
+            conf, j = conf[b, a], j[b, a]
+        x = torch.cat((xywh2xyxy(box[b, a]), conf[:, None], j[:, None].float(), mask[b, a]), 1)
+
+        # Filter by class
+        if classes is not None:
+            keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+            b, x = b[keep], x[keep]
+
+        # Sort by image, then confidence, keeping the max_nms most confident boxes per image
+        i = x[:, 4].argsort(descending=True, stable=True)
+        i = i[b[i].argsort(stable=True)]
+        b, x = b[i], x[i]
+        counts = torch.bincount(b, minlength=bs)
+        i = (torch.arange(len(b), device=b.device) - (counts.cumsum(0) - counts)[b]) < max_nms
+        b, x = b[i], x[i]
+
+        # Batched NMS over (image, class) groups, float64 so that the group coordinate offsets stay exact
+        idxs = b if agnostic else b * nc + x[:, 5].long()
+        i = torchvision.ops.batched_nms(x[:, :4].double(), x[:, 4].double(), idxs, iou_thres)  # by descending conf
+        i = i[b[i].argsort(stable=True)]  # by image, then confidence
+        counts = torch.bincount(b[i], minlength=bs)
+        i = i[(torch.arange(len(i), device=i.device) - (counts.cumsum(0) - counts)[b[i]]) < max_det]  # limit detections
+        output = list(x[i].split(counts.clamp(max=max_det).tolist()))
+        return [xi.to(device) for xi in output] if mps else output
+
     t = time.time()
     output = [torch.zeros((0, 6 + nm), device=prediction.device)] * bs
     for xi, x in enumerate(prediction):  # image index, image inference
@@ -1005,7 +1067,9 @@ def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_op
     x['model'].half()  # to FP16
     for p in x['model'].parameters():
         p.requires_grad = False
-    torch.save(x, s or f)
+    tmp = Path(s or f).with_name(f'.{Path(s or f).name}.tmp')
+    torch.save(x, tmp)
+    os.replace(tmp, s or f)  # new file, hard links to the unstripped checkpoint (best.pt, epoch*.pt) are kept
     mb = os.path.getsize(s or f) / 1E6  # filesize
     LOGGER.info(f"Optimizer stripped from {f},{f' saved as {s},' if s else ''} {mb:.1f}MB")
 
@@ -4,8 +4,8 @@ import random
 import cv2
 import numpy as np
 
-from ..augmentations import box_candidates
-from ..general import resample_segments, segment2box
+from ..augmentations import box_candidates, warp_segments
+from ..general import segments2boxes_clip
 from ..metrics import bbox_ioa
 
 
@@ -83,42 +83,15 @@ def random_perspective(im,
     new_segments = []
     new_semantic_masks = []
     if n:
-        new = np.zeros((n, 4))
-        segments = resample_segments(segments)  # upsample
-        for i, segment in enumerate(segments):
-            xy = np.ones((len(segment), 3))
-            xy[:, :2] = segment
-            xy = xy @ M.T  # transform
-            xy = (xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2])  # perspective rescale or affine
-
-            # clip
-            new[i] = segment2box(xy, width, height)
-            new_segments.append(xy)
-
-        semantic_masks = resample_segments(semantic_masks)
-        for i, semantic_mask in enumerate(semantic_masks):
-            #if i < n:
-            #    xy = np.ones((len(segments[i]), 3))
-            #    xy[:, :2] = segments[i]
-            #    xy = xy @ M.T  # transform
-            #    xy = (xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2])  # perspective rescale or affine
-
-            #    new[i] = segment2box(xy, width, height)
-            #    new_segments.append(xy)
-
-            xy_s = np.ones((len(semantic_mask), 3))
-            xy_s[:, :2] = semantic_mask
-            xy_s = xy_s @ M.T  # transform
-            xy_s = (xy_s[:, :2] / xy_s[:, 2:3] if perspective else xy_s[:, :2])  # perspective rescale or affine
-
-            new_semantic_masks.append(xy_s)
+        new_segments = warp_segments(segments, M, perspective)  # (n,1000,2) resampled and transformed
+        new = segments2boxes_clip(new_segments, width, height)  # clip
+        new_semantic_masks = warp_segments(semantic_masks, M, perspective)
 
         # filter candidates
         i = box_candidates(box1=targets[:, 1:5].T * s, box2=new.T, area_thr=0.01)
         targets = targets[i]
         targets[:, 1:5] = new[i]
-        new_segments = np.array(new_segments)[i]
-        new_semantic_masks = np.array(new_semantic_masks)
+        new_segments = new_segments[i]
 
     return im, targets, new_segments, new_semantic_masks
 
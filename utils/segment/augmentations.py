@@ -4,8 +4,8 @@ import random
 import cv2
 import numpy as np
 
-from ..augmentations import box_candidates
-from ..general import resample_segments, segment2box
+from ..augmentations import box_candidates, warp_segments
+from ..general import segments2boxes_clip
 
 
 def mixup(im, labels, segments, im2, labels2, segments2):
@@ -78,22 +78,13 @@ def random_perspective(im,
     n = len(targets)
     new_segments = []
     if n:
-        new = np.zeros((n, 4))
-        segments = resample_segments(segments)  # upsample
-        for i, segment in enumerate(segments):
-            xy = np.ones((len(segment), 3))
-            xy[:, :2] = segment
-            xy = xy @ M.T  # transform
-            xy = (xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2])  # perspective rescale or affine
-
-            # clip
-            new[i] = segment2box(xy, width, height)
-            new_segments.append(xy)
+        new_segments = warp_segments(segments, M, perspective)  # (n,1000,2) resampled and transformed
+        new = segments2boxes_clip(new_segments, width, height)  # clip
 
         # filter candidates
         i = box_candidates(box1=targets[:, 1:5].T * s, box2=new.T, area_thr=0.01)
         targets = targets[i]
         targets[:, 1:5] = new[i]
-        new_segments = np.array(new_segments)[i]
+        new_segments = new_segments[i]
 
     return im, targets, new_segments
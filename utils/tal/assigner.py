@@ -22,6 +22,17 @@ def select_candidates_in_gts(xy_centers, gt_bboxes, eps=1e-9):
     return bbox_deltas.amin(3).gt_(eps)
 
 
+def power(x, p):
+    """x ** p with integer p as repeated products, which unlike the vectorized CPU pow() do not depend on the
+    position of an element in the tensor (forward_sparse() must match the dense path bit for bit)"""
+    if not float(p).is_integer() or p < 2:
+        return x.pow(p)
+    y = x * x
+    for _ in range(int(p) - 2):
+        y.mul_(x)
+    return y
+
+
 def select_highest_overlaps(mask_pos, overlaps, n_max_boxes):
     """if an anchor box is assigned to multiple gts,
         the one with the highest iou will be selected.
@@ -49,7 +60,7 @@ def select_highest_overlaps(mask_pos, overlaps, n_max_boxes):
 
 
 class TaskAlignedAssigner(nn.Module):
-    def __init__(self, topk=13, num_classes=80, alpha=1.0, beta=6.0, eps=1e-9):
+    def __init__(self, topk=13, num_classes=80, alpha=1.0, beta=6.0, eps=1e-9, sparse=False, chunk=32):
         super().__init__()
         self.topk = topk
         self.num_classes = num_classes
@@ -57,6 +68,8 @@ class TaskAlignedAssigner(nn.Module):
         self.alpha = alpha
         self.beta = beta
         self.eps = eps
+        self.sparse = sparse  # forward_sparse(): only (gt, anchor) pairs with the anchor inside the gt
+        self.chunk = chunk  # gts per select_candidates_in_gts() call in sparse mode
 
     @torch.no_grad()
     def forward(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt):
@@ -70,6 +83,8 @@ class TaskAlignedAssigner(nn.Module):
             gt_labels (Tensor): shape(bs, n_max_boxes, 1)
             gt_bboxes (Tensor): shape(bs, n_max_boxes, 4)
             mask_gt (Tensor): shape(bs, n_max_boxes, 1)
+            (pd_scores and pd_bboxes may stack several heads along the batch, shape(heads * bs, ...), to assign
+             all heads against the same gts in one call)
         Returns:
             target_labels (Tensor): shape(bs, num_total_anchors)
             target_bboxes (Tensor): shape(bs, num_total_anchors, 4)
@@ -86,6 +101,13 @@ class TaskAlignedAssigner(nn.Module):
                     torch.zeros_like(pd_scores).to(device),
                     torch.zeros_like(pd_scores[..., 0]).to(device))
 
+        if self.sparse:
+            return self.forward_sparse(pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt)
+
+        heads = self.bs // gt_bboxes.size(0)
+        if heads > 1:
+            gt_labels, gt_bboxes, mask_gt = (x.repeat(heads, 1, 1) for x in (gt_labels, gt_bboxes, mask_gt))
+
         mask_pos, align_metric, overlaps = self.get_pos_mask(pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points,
                                                              mask_gt)
 
@@ -103,6 +125,77 @@ class TaskAlignedAssigner(nn.Module):
 
         return target_labels, target_bboxes, target_scores, fg_mask.bool()
 
+    def forward_sparse(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt):
+        """forward() on candidate lists instead of dense (b, max_num_obj, h*w) tensors
+
+        Metrics are computed only for anchors inside valid gts (found in chunks of gts), the per-gt top-k is taken by
+        sorting the candidates instead of F.one_hot(topk_idxs, h*w), and targets are written with scatter. The outputs
+        are identical to the dense path (tests/test_assigner.py).
+        """
+        bs, n, na = self.bs, self.n_max_boxes, anc_points.shape[0]
+        device = gt_bboxes.device
+
+        # candidates (b, gt, anchor) with the anchor center inside a valid gt
+        cand = []
+        for i in range(0, n, self.chunk):
+            mask = select_candidates_in_gts(anc_points, gt_bboxes[:, i:i + self.chunk].contiguous())
+            c = (mask.bool() & mask_gt[:, i:i + self.chunk].bool()).nonzero()
+            c[:, 1] += i
+            cand.append(c)
+        cand = torch.cat(cand)
+        heads = bs // gt_bboxes.size(0)
+        if heads > 1:  # heads stacked along the batch share the gt candidates
+            offset = cand.new_tensor([gt_bboxes.size(0), 0, 0])
+            cand = torch.cat([cand + k * offset for k in range(heads)])
+            gt_labels, gt_bboxes = gt_labels.repeat(heads, 1, 1), gt_bboxes.repeat(heads, 1, 1)
+        b, g, a = cand.unbind(1)
+        labels = gt_labels.long().squeeze(-1)  # b, max_num_obj
+        overlaps = bbox_iou(gt_bboxes[b, g], pd_bboxes[b, a], xywh=False, CIoU=True).squeeze(-1).clamp(0)
+        align_metric = power(pd_scores[b, a, labels[b, g]], self.alpha) * power(overlaps, self.beta)
+        i = align_metric > 0  # as get_pos_mask(), zero-metric candidates are never positive
+        b, g, a, align_metric, overlaps = b[i], g[i], a[i], align_metric[i], overlaps[i]
+
+        # top-k candidates of every gt and their ties with the k-th one: sort by metric, then (stable) by gt
+        key = b * n + g
+        i = align_metric.argsort(descending=True)
+        i = i[key[i].argsort(stable=True)]
+        b, g, a, align_metric, overlaps, key = b[i], g[i], a[i], align_metric[i], overlaps[i], key[i]
+        rank = torch.arange(len(key), device=device) - torch.searchsorted(key, key)
+        kth = align_metric.new_full((bs * n,), -1)  # metric of the k-th candidate of every gt
+        kth[key[rank == self.topk - 1]] = align_metric[rank == self.topk - 1]
+        i = (rank < self.topk) | (align_metric == kth[key])
+        b, g, a, align_metric, overlaps = b[i], g[i], a[i], align_metric[i], overlaps[i]
+
+        # anchors assigned to several gts go to the gt with the highest overlap, as in select_highest_overlaps()
+        flat = b * na + a
+        multi = torch.bincount(flat, minlength=bs * na)[flat] > 1
+        if multi.any():
+            mf = flat[multi].unique()
+            mb, ma = mf // na, mf % na
+            ov = bbox_iou(gt_bboxes[mb], pd_bboxes[mb, ma].unsqueeze(1), xywh=False, CIoU=True).squeeze(-1).clamp(0)
+            ov, mg = ov.max(1)  # first max, like argmax
+            am = power(pd_scores[mb, ma, labels[mb, mg]], self.alpha) * power(ov, self.beta)
+            single = ~multi
+            b, g, a = torch.cat((b[single], mb)), torch.cat((g[single], mg)), torch.cat((a[single], ma))
+            align_metric, overlaps = torch.cat((align_metric[single], am)), torch.cat((overlaps[single], ov))
+
+        # assigned target
+        target_gt_idx = torch.zeros(bs, na, dtype=torch.long, device=device)
+        target_gt_idx[b, a] = g
+        fg_mask = torch.zeros(bs, na, dtype=torch.bool, device=device)
+        fg_mask[b, a] = True
+        target_labels, target_bboxes, target_scores = self.get_targets(gt_labels, gt_bboxes, target_gt_idx, fg_mask)
+
+        # normalize
+        key = b * n + g
+        pos_align_metrics = align_metric.new_zeros(bs * n).scatter_reduce_(0, key, align_metric, 'amax')
+        pos_overlaps = overlaps.new_zeros(bs * n).scatter_reduce_(0, key, overlaps, 'amax')
+        norm_align_metric = align_metric.new_zeros(bs, na)
+        norm_align_metric[b, a] = align_metric * pos_overlaps[key] / (pos_align_metrics[key] + self.eps)
+        target_scores = target_scores * norm_align_metric.unsqueeze(-1)
+
+        return target_labels, target_bboxes, target_scores, fg_mask
+
     def get_pos_mask(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points, mask_gt):
 
         # get anchor_align metric, (b, max_num_obj, h*w)
@@ -110,8 +203,9 @@ class TaskAlignedAssigner(nn.Module):
         # get in_gts mask, (b, max_num_obj, h*w)
         mask_in_gts = select_candidates_in_gts(anc_points, gt_bboxes)
         # get topk_metric mask, (b, max_num_obj, h*w)
-        mask_topk = self.select_topk_candidates(align_metric * mask_in_gts,
-                                                topk_mask=mask_gt.repeat([1, 1, self.topk]).bool())
+        # ties with the k-th metric are all kept and zero metrics dropped, topk() breaks ties in an arbitrary order
+        metrics = align_metric * mask_in_gts
+        mask_topk = (metrics >= metrics.topk(self.topk, dim=-1).values[..., -1:]) & (metrics > 0)
         # merge all mask to a final mask, (b, max_num_obj, h*w)
         mask_pos = mask_topk * mask_in_gts * mask_gt
 
@@ -127,7 +221,7 @@ class TaskAlignedAssigner(nn.Module):
         bbox_scores = pd_scores[ind[0], :, ind[1]]  # b, max_num_obj, h*w
 
         overlaps = bbox_iou(gt_bboxes.unsqueeze(2), pd_bboxes.unsqueeze(1), xywh=False, CIoU=True).squeeze(3).clamp(0)
-        align_metric = bbox_scores.pow(self.alpha) * overlaps.pow(self.beta)
+        align_metric = power(bbox_scores, self.alpha) * power(overlaps, self.beta)
         return align_metric, overlaps
 
     def select_topk_candidates(self, metrics, largest=True, topk_mask=None):
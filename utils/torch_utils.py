@@ -1,13 +1,17 @@
 import math
 import os
 import platform
+import random
+import shutil
 import subprocess
 import time
 import warnings
 from contextlib import contextmanager
 from copy import deepcopy
 from pathlib import Path
+from threading import Thread
 
+import numpy as np
 import torch
 import torch.distributed as dist
 import torch.nn as nn
@@ -458,23 +462,131 @@ def smart_hub_load(repo='ultralytics/yolov5', model='yolov5s', **kwargs):
 def smart_resume(ckpt, optimizer, ema=None, weights='yolov5s.pt', epochs=300, resume=True):
     # Resume training from a partially trained checkpoint
     best_fitness = 0.0
-    start_epoch = ckpt['epoch'] + 1
+    start_epoch = ckpt['epoch'] + (0 if ckpt.get('step') else 1)  # mid-epoch checkpoints resume inside their epoch
     if ckpt['optimizer'] is not None:
         optimizer.load_state_dict(ckpt['optimizer'])  # optimizer
         best_fitness = ckpt['best_fitness']
     if ema and ckpt.get('ema'):
         ema.ema.load_state_dict(ckpt['ema'].float().state_dict())  # EMA
         ema.updates = ckpt['updates']
+        ema.pending = ckpt.get('ema_pending', 1.0)
     if resume:
         assert start_epoch > 0, f'{weights} training to {epochs} epochs is finished, nothing to resume.\n' \
                                 f"Start a new training without --resume, i.e. 'python train.py --weights {weights}'"
-        LOGGER.info(f'Resuming training from {weights} from epoch {start_epoch} to {epochs} total epochs')
+        step = f" step {ckpt['step']}" if ckpt.get('step') else ''
+        LOGGER.info(f'Resuming training from {weights} from epoch {start_epoch}{step} to {epochs} total epochs')
     if epochs < start_epoch:
         LOGGER.info(f"{weights} has been trained for {ckpt['epoch']} epochs. Fine-tuning for {epochs} more epochs.")
         epochs += ckpt['epoch']  # finetune additional epochs
     return best_fitness, start_epoch, epochs
 
 
+def get_rng_state():
+    # Python, NumPy, torch and CUDA RNG states, for exact mid-epoch resume
+    return {
+        'random': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    # Restore RNG states saved by get_rng_state()
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class AsyncCheckpoint:
+    """ Saves checkpoints from a background thread, one at a time, through a temporary file and os.replace()
+
+    snapshot() copies modules and (nested) state dicts into reused pinned CPU buffers with non-blocking copies, so the
+    training thread only enqueues device-to-host transfers; the writer waits for them before serialising. A failed
+    write is re-raised in the training thread by the next wait(), snapshot() or save().
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None  # exception of the last background write
+        self.shadows = {}  # name: CPU module or {path: pinned tensor}
+        self.event = None  # CUDA event after the last snapshot copies
+
+    def snapshot(self, x, name, half=False):
+        # CPU copy of module or state dict 'x', valid until the next snapshot(name) (reused buffers)
+        self.wait()  # previous checkpoint may still be serialising these buffers
+        if isinstance(x, nn.Module):
+            shadow = self.shadows.get(name)
+            src = x.state_dict()
+            dst = shadow.state_dict() if shadow is not None else {}
+            if dst.keys() != src.keys() or any(dst[k].shape != v.shape for k, v in src.items()):
+                shadow = deepcopy(x).cpu()
+                shadow = shadow.half() if half else shadow
+                if torch.cuda.is_available():
+                    for t in (*shadow.parameters(), *shadow.buffers()):
+                        t.data = t.data.pin_memory()
+                self.shadows[name], dst = shadow, shadow.state_dict()
+            for k, v in src.items():
+                dst[k].copy_(v.detach(), non_blocking=True)
+            copy_attr(shadow, x, exclude=('training',))  # yaml, names, hyp, ...
+            y = shadow
+        else:
+            y = self._copy(x, self.shadows.setdefault(name, {}), ())
+        if torch.cuda.is_available():
+            self.event = torch.cuda.Event()
+            self.event.record()
+        return y
+
+    def _copy(self, x, buffers, path):
+        if isinstance(x, torch.Tensor):
+            b = buffers.get(path)
+            if b is None or b.shape != x.shape or b.dtype != x.dtype:
+                b = buffers[path] = torch.empty(x.shape, dtype=x.dtype, pin_memory=torch.cuda.is_available())
+            return b.copy_(x.detach(), non_blocking=True)
+        if isinstance(x, dict):
+            return {k: self._copy(v, buffers, path + (k,)) for k, v in x.items()}
+        if isinstance(x, (list, tuple)):
+            return type(x)(self._copy(v, buffers, path + (i,)) for i, v in enumerate(x))
+        return deepcopy(x)
+
+    def save(self, ckpt, f, links=()):
+        # Write ckpt to f, then hard-link every path in links to it (same epoch, serialised once)
+        self.wait()
+        self.thread = Thread(target=self._save, args=(ckpt, Path(f), [Path(x) for x in links], self.event))
+        self.thread.start()
+
+    def _save(self, ckpt, f, links, event):
+        try:
+            self._write(ckpt, f, links, event)
+        except BaseException as e:  # disk full, permissions, ...
+            self.error = e
+
+    @staticmethod
+    def _write(ckpt, f, links, event):
+        if event is not None:
+            event.synchronize()  # snapshot copies done
+        tmp = f.with_name(f'.{f.name}.tmp')
+        torch.save(ckpt, tmp)
+        os.replace(tmp, f)  # atomic, a preempted write never leaves a truncated checkpoint
+        for x in links:
+            tmp = x.with_name(f'.{x.name}.tmp')
+            tmp.unlink(missing_ok=True)
+            try:
+                os.link(f, tmp)
+            except OSError:  # no hard links on this filesystem
+                shutil.copyfile(f, tmp)
+            os.replace(tmp, x)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise RuntimeError('background checkpoint save failed') from e
+
+
 class EarlyStopping:
     # YOLOv5 simple early stopper
     def __init__(self, patience=30):
@@ -504,26 +616,49 @@ class ModelEMA:
     For EMA details see https://www.tensorflow.org/api_docs/python/tf/train/ExponentialMovingAverage
     """
 
-    def __init__(self, model, decay=0.9999, tau=2000, updates=0):
+    def __init__(self, model, decay=0.9999, tau=2000, updates=0, every=1):
         # Create EMA
         self.ema = deepcopy(de_parallel(model)).eval()  # FP32 EMA
         self.updates = updates  # number of EMA updates
         self.decay = lambda x: decay * (1 - math.exp(-x / tau))  # decay exponential ramp (to help early epochs)
+        self.every = every  # apply every x updates, with the decays of the skipped updates compounded
+        self.pending = 1.0  # compounded decay not yet applied
+        self.tensors = None  # cached (model, EMA tensors, model tensors, sentinels)
         for p in self.ema.parameters():
             p.requires_grad_(False)
 
     def update(self, model):
         # Update EMA parameters
         self.updates += 1
-        d = self.decay(self.updates)
-
-        msd = de_parallel(model).state_dict()  # model state_dict
-        for k, v in self.ema.state_dict().items():
-            if v.dtype.is_floating_point:  # true for FP16 and FP32
-                v *= d
-                v += (1 - d) * msd[k].detach()
+        self.pending *= self.decay(self.updates)
+        if self.updates % self.every == 0:
+            self._apply(model)
+
+    def _apply(self, model):
+        # ema = d * ema + (1 - d) * model for all floating point tensors, as a few multi-tensor kernels
+        d, self.pending = self.pending, 1.0
+        ema, msd = self._get_tensors(de_parallel(model))
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(ema, msd, 1 - d)
+            else:  # torch<1.13
+                torch._foreach_mul_(ema, d)
+                torch._foreach_add_(ema, msd, alpha=1 - d)
         # assert v.dtype == msd[k].dtype == torch.float32, f'{k}: EMA {v.dtype} and model {msd[k].dtype} must be FP32'
 
+    def _get_tensors(self, model):
+        # Flat lists of EMA and model parameters/buffers, rebuilt only when a module was re-cast (e.g. val .half())
+        c = self.tensors
+        if c is None or c[0] is not model or any(m._buffers[k] is not b for m, k, b in c[3]):
+            esd, msd = self.ema.state_dict(keep_vars=True), model.state_dict(keep_vars=True)
+            keys = [k for k, v in esd.items() if v.dtype.is_floating_point]  # true for FP16 and FP32
+            sentinels = [next(((m, k, b) for m in x.modules() for k, b in m._buffers.items() if b is not None),
+                              None) for x in (self.ema, model)]
+            self.tensors = c = model, [esd[k] for k in keys], [msd[k] for k in keys], [x for x in sentinels if x]
+        return c[1], c[2]
+
     def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
-        # Update EMA attributes
+        # Update EMA attributes, applying any pending every-x update first
+        if self.pending != 1.0:
+            self._apply(model)
         copy_attr(self.ema, model, include, exclude)
@@ -204,7 +204,8 @@ def run(
                                         labels=lb,
                                         multi_label=True,
                                         agnostic=single_cls,
-                                        max_det=max_det)
+                                        max_det=max_det,
+                                        batched=True)
 
         # Metrics
         for si, pred in enumerate(preds):
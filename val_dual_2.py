@@ -4,7 +4,8 @@
 # - Falls back to data.yaml for nc/names (federated weights often lack meta)
 # - Unwraps model outputs: (pred, aux) / [pred, aux] / {'pred': ...}
 # - Has local scale_coords compatible with letterbox shapes
-# - Forces saving labels/*.txt (YOLO format, with conf), computes mAP@0.5, writes results.txt/results.csv
+# - Saves predictions as one columnar predictions.npz (or labels/*.txt with --save-format txt), computes mAP@0.5,
+#   writes results.txt/results.csv
 
 import argparse
 import os
@@ -21,6 +22,7 @@ from utils.general import (
 from utils.torch_utils import select_device, time_sync
 from utils.dataloaders import create_dataloader
 from models.common import DetectMultiBackend
+from fed_score import PredStoreWriter, eval_map50, load_gt, load_pred_npz
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]
@@ -173,14 +175,16 @@ def eval_map50_from_txt(pred_dir, gt_dir, nc):
 def run(data, weights='best.pt', batch_size=16, imgsz=640, conf_thres=0.001, iou_thres=0.65,
         device='', workers=0, single_cls=False, augment=False, verbose=True,
         save_txt=False, save_conf=False, project='runs/val_dual', name='exp',
-        exist_ok=False, half=False, dnn=False, max_det=300, min_items=0):
+        exist_ok=False, half=False, dnn=False, max_det=300, min_items=0, save_format='npz'):
 
-    # 強制存 txt（為了後面計算 mAP）；同時把 conf 一起存
-    save_txt = True
+    # 強制存預測（為了後面計算 mAP）；同時把 conf 一起存
+    save_txt = save_format == 'txt'
     save_conf = True
 
     save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)
-    (save_dir / 'labels').mkdir(parents=True, exist_ok=True)
+    (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)
+    # npz：每個 batch 追加到單一列式檔，取代每張影像一個 txt
+    store = None if save_txt else PredStoreWriter(save_dir / 'predictions.npz')
 
     set_logging()
     device = select_device(device, batch_size=batch_size)
@@ -236,16 +240,19 @@ def run(data, weights='best.pt', batch_size=16, imgsz=640, conf_thres=0.001, iou
                 pred[:, :4] = scale_coords_local(im[si].shape[1:], pred[:, :4], orig_shape, ratio_pad).round()
                 # 存 YOLO 標註（normalized）— 全在 CPU 做，避免 device mismatch
                 gn = torch.tensor((orig_shape[1], orig_shape[0], orig_shape[1], orig_shape[0]), dtype=torch.float32)
+                pred = pred.float().cpu()
+                if store is not None:
+                    store.add(p.stem, pred[:, 5].numpy(), pred[:, 4].numpy(), (pred[:, :4] / gn).numpy())
+                    continue
                 txt_path = save_dir / 'labels' / f'{p.stem}.txt'
-                if txt_path.exists():  # 避免覆寫疊行
-                    txt_path.unlink()
-                for *xyxy, conf, cls in pred.tolist():
-                    xyxy_t = torch.tensor(xyxy, dtype=torch.float32).view(1, 4)
-                    xywh = (xyxy2xywh(xyxy_t) / gn).view(-1).tolist()
-                    line = (int(cls), *xywh, conf) if save_conf else (int(cls), *xywh)
-                    with open(txt_path, 'a') as f:
+                xywh = xyxy2xywh(pred[:, :4]) / gn
+                with open(txt_path, 'w') as f:  # 每張影像只開檔一次（覆寫避免疊行）
+                    for cls, box, conf in zip(pred[:, 5].tolist(), xywh.tolist(), pred[:, 4].tolist()):
+                        line = (int(cls), *box, conf) if save_conf else (int(cls), *box)
                         f.write(('%g ' * len(line)).rstrip() % line + '\n')
 
+        if store is not None:
+            store.flush()
         if verbose and (batch_i % 20 == 0):
             LOGGER.info(f'[{batch_i}/{len(dataloader)}] {(t2 - t1)*1e3:.1f}ms pre, {(t3 - t2)*1e3:.1f}ms inf')
 
@@ -255,14 +262,20 @@ def run(data, weights='best.pt', batch_size=16, imgsz=640, conf_thres=0.001, iou
         gt_dir = val_path.parent / 'labels'
     else:
         gt_dir = Path(str(val_path).replace('images', 'labels'))
-    pred_dir = save_dir / 'labels'
-    
+    pred_dir = save_dir / 'labels' if save_txt else store.close()
+
     #檢查gt跟pred路徑
-    print(f"[VAL] pred_dir={pred_dir.resolve()}")
+    print(f"[VAL] pred_dir={Path(pred_dir).resolve()}")
     print(f"[VAL] gt_dir={gt_dir.resolve()}")
-    assert pred_dir.resolve() != gt_dir.resolve(), "Pred dir 和 GT dir 指到同一路徑！請檢查。"
-    
-    mAP, aps = eval_map50_from_txt(str(pred_dir), str(gt_dir), nc)
+    assert Path(pred_dir).resolve() != gt_dir.resolve(), "Pred dir 和 GT dir 指到同一路徑！請檢查。"
+
+    if save_txt:
+        mAP, aps = eval_map50_from_txt(str(pred_dir), str(gt_dir), nc)
+    else:
+        gt, npos, img_ids = load_gt(str(gt_dir), nc)
+        _, aps, _ = eval_map50(load_pred_npz(pred_dir, nc, img_ids), gt, npos, nc=nc)
+        aps[npos == 0] = np.nan
+        mAP = float(np.nanmean(aps)) if (npos > 0).any() else 0.0
 
     # 寫 results.txt / results.csv
     results_txt = save_dir / 'results.txt'
@@ -301,6 +314,8 @@ def parse_opt():
     p.add_argument('--augment', action='store_true', help='augmented inference')
     p.add_argument('--verbose', action='store_true', help='verbose log')
     p.add_argument('--save-txt', action='store_true', help='(ignored; always save for eval)')
+    p.add_argument('--save-format', default='npz', choices=['npz', 'txt'],
+                   help='prediction store: single columnar predictions.npz or per-image labels/*.txt')
     p.add_argument('--save-conf', action='store_true', help='(ignored; always save for eval)')
     p.add_argument('--project', default='runs/val_dual', help='save to project/name')
     p.add_argument('--name', default='exp', help='save to project/name')